@@ -0,0 +1,395 @@
+import os
+import random
+import time
+from collections import Counter, defaultdict
+from slot_utils import parse_slot, sort_slots
+
+# --- シフト割り当て ---
+
+UNFILLED = "❌"
+CONTIGUOUS_BONUS = -50     # 同じ日の前の枠から連続する2枠目
+NON_CONTIGUOUS_PENALTY = 999  # 同じ日の離れた2枠目
+MAX_PER_DAY = 2
+
+
+def past_counts_from_aggregate(df_counts):
+    # history_counts (受講者, 学期, 回数) から (受講者, 学期) -> 回数 の索引を1回だけ作る
+    return Counter({(r, sem): int(n) for r, sem, n in zip(df_counts["受講者"], df_counts["学期"], df_counts["回数"])})
+
+
+def build_slot_applicants(slots, req_map):
+    # 枠 -> 応募者 (req_map の順番を保つ)
+    slot_applicants = {s: [] for s in slots}
+    for name, wishes in req_map.items():
+        for w in wishes:
+            if w in slot_applicants: slot_applicants[w].append(name)
+    return slot_applicants
+
+
+def allocate_greedy(slots, req_map, past_counts, rng=random, pinned=None):
+    # 年度順に枠を見て、(今期の回数 + 連続ボーナス/離れ枠ペナルティ, 乱数) が最小の人を選ぶ
+    # pinned: 先に決まっている {枠: 受講者}。そのまま残し、回数・同日の枠として数える
+    # 戻り値: {枠: 受講者}  (誰も入らない枠は含まない)
+    slot_applicants = build_slot_applicants(slots, req_map)
+    final_schedule = {}
+    current_batch_counts = defaultdict(int)
+    daily_counts = defaultdict(int)       # (受講者, 日付) -> 枠数
+    daily_times = defaultdict(list)       # (受講者, 日付) -> [(開始, 終了)]
+    for slot, student in (pinned or {}).items():
+        info = parse_slot(slot)
+        final_schedule[slot] = student
+        current_batch_counts[student] += 1
+        daily_counts[(student, info.date)] += 1
+        daily_times[(student, info.date)].append((info.start or "00:00", info.end or "00:00"))
+
+    for slot in sort_slots(slots):
+        if slot in final_schedule: continue
+        cands = slot_applicants[slot]
+        if not cands: continue
+
+        info = parse_slot(slot)
+        semester = info.semester
+        date_part, s_time, e_time = info.date, info.start or "00:00", info.end or "00:00"
+
+        scored_cands = []
+        for student in cands:
+            day_key = (student, date_part)
+            if daily_counts[day_key] >= MAX_PER_DAY: continue
+            total_count = past_counts.get((student, semester), 0) + current_batch_counts[student]
+            penalty = 0
+            if daily_counts[day_key] == 1:
+                # 前後どちらかに隣接していれば連続 (固定枠が後ろにある場合も含む)
+                if any(end == s_time or start == e_time for start, end in daily_times[day_key]): penalty = CONTIGUOUS_BONUS
+                else: penalty = NON_CONTIGUOUS_PENALTY
+            scored_cands.append((total_count + penalty, rng.random(), student))
+
+        if scored_cands:
+            winner = min(scored_cands)[2]
+            final_schedule[slot] = winner
+            current_batch_counts[winner] += 1
+            daily_counts[(winner, date_part)] += 1
+            daily_times[(winner, date_part)].append((s_time, e_time))
+    return final_schedule
+
+
+# --- 下書きからの部分的な再計算 ---
+# 希望が変わった学生の枠・空いている枠・新しい枠だけを組み直し、他の割り当ては動かさない。
+
+def changed_students(old_wishes, new_wishes):
+    # 希望の集合が変わった学生 (新しく出した人・取り下げた人を含む)
+    names = set(old_wishes) | set(new_wishes)
+    return sorted(n for n in names if set(old_wishes.get(n, ())) != set(new_wishes.get(n, ())))
+
+
+def replan(slots, req_map, past_counts, draft_schedule, students, rng=random):
+    # students: 組み直す学生。戻り値: (新しい {枠: 受講者}, 組み直した枠の集合)
+    students = set(students)
+    wanted = {n: set(s) for n, s in req_map.items()}
+    slot_set = set(slots)
+    pinned = {
+        slot: student for slot, student in draft_schedule.items()
+        # 枠が消えた・希望が取り下げられた・組み直す学生の枠は外す
+        if slot in slot_set and slot in wanted.get(student, ()) and student not in students
+    }
+    schedule = allocate_greedy(slots, req_map, past_counts, rng, pinned=pinned)
+    # 組み直した枠 = 固定していない枠のうち応募者がいるもの
+    slot_applicants = build_slot_applicants(slots, req_map)
+    return schedule, {s for s in slot_set - set(pinned) if slot_applicants[s]}
+
+
+def schedule_diff(slots, old, new):
+    # 割り当てが変わった枠 (年度順): [(枠, 前, 後)]  空き枠は UNFILLED
+    return [(s, old.get(s, UNFILLED), new.get(s, UNFILLED))
+            for s in sort_slots(set(slots) | set(old)) if old.get(s) != new.get(s)]
+
+
+# --- 最適化モード (最小費用流 + 局所探索) ---
+# 目的関数: 埋まらない枠 × UNFILLED_COST
+#           + 各学生・学期の (過去回数 + 今回k回目) の和 (回数が偏るほど大きい)
+#           + 同じ日の2枠目の連続ボーナス / 離れ枠ペナルティ (貪欲法と同じ重み)
+
+UNFILLED_COST = 10_000
+INFEASIBLE = float("inf")
+
+
+def student_cost(student, assigned, past_counts):
+    cost = 0
+    by_sem = Counter(parse_slot(s).semester for s in assigned)
+    for sem, n in by_sem.items():
+        p = past_counts.get((student, sem), 0)
+        cost += n * p + n * (n - 1) // 2   # sum(p + k for k in range(n))
+    by_day = defaultdict(list)
+    for s in assigned:
+        info = parse_slot(s)
+        by_day[info.date].append(info)
+    for day_slots in by_day.values():
+        if len(day_slots) > MAX_PER_DAY: return INFEASIBLE
+        if len(day_slots) == 2:
+            a, b = sorted(day_slots, key=lambda x: x.sort_key)
+            cost += CONTIGUOUS_BONUS if a.end == b.start else NON_CONTIGUOUS_PENALTY
+    return cost
+
+
+def schedule_cost(slots, req_map, past_counts, schedule):
+    slot_applicants = build_slot_applicants(slots, req_map)
+    assigned = defaultdict(list)
+    for slot, student in schedule.items(): assigned[student].append(slot)
+    unfilled = sum(1 for s, c in slot_applicants.items() if c and s not in schedule)
+    return unfilled * UNFILLED_COST + sum(student_cost(n, a, past_counts) for n, a in assigned.items())
+
+
+def _min_cost_flow_assign(req_map, past_counts, slot_applicants, deadline, clock):
+    # source -> (学生, 学期) [k本目の辺の費用 = 過去回数 + k]
+    #        -> (学生, 日付) [容量 MAX_PER_DAY]
+    #        -> 枠 [容量1] -> sink [費用 -UNFILLED_COST]
+    graph = []   # node -> [[to, cap, cost, rev_index], ...]
+
+    def add_node():
+        graph.append([])
+        return len(graph) - 1
+
+    def add_edge(u, v, cap, cost):
+        graph[u].append([v, cap, cost, len(graph[v])])
+        graph[v].append([u, 0, -cost, len(graph[u]) - 1])
+
+    source, sink = add_node(), add_node()
+    slot_node = {s: add_node() for s, c in slot_applicants.items() if c}
+    for s, node in slot_node.items(): add_edge(node, sink, 1, -UNFILLED_COST)
+
+    sem_node, day_node = {}, {}
+    wish_edges = []   # (学生, 枠, ノード, 辺の位置)
+    for student, wishes in req_map.items():
+        wishes = set(wishes)
+        wished = [s for s in slot_node if s in wishes]
+        for s in wished:
+            info = parse_slot(s)
+            sk, dk = (student, info.semester), (student, info.date)
+            if sk not in sem_node:
+                sem_node[sk] = add_node()
+                n_sem = sum(1 for w in wished if parse_slot(w).semester == info.semester)
+                p = past_counts.get(sk, 0)
+                for k in range(n_sem): add_edge(source, sem_node[sk], 1, p + k)
+            if dk not in day_node:
+                day_node[dk] = add_node()
+                add_edge(sem_node[sk], day_node[dk], MAX_PER_DAY, 0)
+            wish_edges.append((student, s, day_node[dk], len(graph[day_node[dk]])))
+            add_edge(day_node[dk], slot_node[s], 1, 0)
+
+    # 逐次最短路 (負の費用があるので Bellman-Ford / SPFA)
+    n = len(graph)
+    while clock() < deadline:
+        dist = [INFEASIBLE] * n
+        prev = [None] * n
+        in_queue = [False] * n
+        dist[source] = 0
+        queue = [source]
+        head = 0
+        while head < len(queue):
+            u = queue[head]; head += 1
+            in_queue[u] = False
+            for i, (v, cap, cost, _) in enumerate(graph[u]):
+                if cap > 0 and dist[u] + cost < dist[v]:
+                    dist[v] = dist[u] + cost
+                    prev[v] = (u, i)
+                    if not in_queue[v]:
+                        in_queue[v] = True
+                        queue.append(v)
+        # これ以上流しても費用が下がらなければ終了
+        if dist[sink] >= 0: break
+        v = sink
+        while v != source:
+            u, i = prev[v]
+            edge = graph[u][i]
+            edge[1] -= 1
+            graph[v][edge[3]][1] += 1
+            v = u
+
+    return {s: student for student, s, node, i in wish_edges if graph[node][i][1] == 0}
+
+
+def _improve(past_counts, slot_applicants, schedule, deadline, clock, rng):
+    # 1枠の担当替え / 2枠の入れ替えを試し、悪くならない手を採用する
+    owner = dict(schedule)
+    assigned = defaultdict(set)
+    for s, student in owner.items(): assigned[student].add(s)
+    costs = {student: student_cost(student, a, past_counts) for student, a in assigned.items()}
+    contested = [s for s, c in slot_applicants.items() if c]
+    if not contested: return owner
+
+    def cost_with(student, add=(), remove=()):
+        return student_cost(student, (assigned[student] - set(remove)) | set(add), past_counts)
+
+    stale, max_stale = 0, 200 * len(contested)
+    while stale < max_stale and clock() < deadline:
+        stale += 1
+        s1 = rng.choice(contested)
+        o1 = owner.get(s1)
+        if rng.random() < 0.5:
+            # 担当替え (空き枠なら割り当て)
+            c = rng.choice(slot_applicants[s1])
+            if c == o1: continue
+            new_c = cost_with(c, add=[s1])
+            delta = new_c - costs.get(c, 0)
+            if o1 is None: delta -= UNFILLED_COST
+            else:
+                new_o = cost_with(o1, remove=[s1])
+                delta += new_o - costs[o1]
+            if new_c == INFEASIBLE or delta > 0: continue
+            if delta < 0: stale = 0
+            owner[s1] = c
+            assigned[c].add(s1); costs[c] = new_c
+            if o1 is not None:
+                assigned[o1].discard(s1); costs[o1] = new_o
+        else:
+            # 入れ替え
+            s2 = rng.choice(contested)
+            o2 = owner.get(s2)
+            if s1 == s2 or o1 is None or o2 is None or o1 == o2: continue
+            if o1 not in slot_applicants[s2] or o2 not in slot_applicants[s1]: continue
+            new_o1 = cost_with(o1, add=[s2], remove=[s1])
+            new_o2 = cost_with(o2, add=[s1], remove=[s2])
+            if INFEASIBLE in (new_o1, new_o2): continue
+            delta = new_o1 + new_o2 - costs[o1] - costs[o2]
+            if delta > 0: continue
+            if delta < 0: stale = 0
+            owner[s1], owner[s2] = o2, o1
+            assigned[o1].discard(s1); assigned[o1].add(s2); costs[o1] = new_o1
+            assigned[o2].discard(s2); assigned[o2].add(s1); costs[o2] = new_o2
+    return owner
+
+
+def allocate_optimal(slots, req_map, past_counts, time_budget=2.0, seed=0, clock=None, starts=()):
+    # 最小費用流で「埋まる枠数」と「回数の偏り」を同時に最適化し、
+    # 残り時間で連続2枠を優先するよう局所探索する。
+    # starts: 探索を始める割り当て (画面で比べる貪欲法の結果など)。結果の費用はこれらを超えない。
+    # 省略時は seed の貪欲法から始める。戻り値は allocate_greedy と同じ {枠: 受講者}
+    clock = clock or time.monotonic
+    deadline = clock() + time_budget
+    rng = random.Random(seed)
+    slot_applicants = build_slot_applicants(slots, req_map)
+
+    flow = _min_cost_flow_assign(req_map, past_counts, slot_applicants, deadline, clock)
+    # 貪欲法の結果からも探索し、良い方を採用する
+    starts = [flow] + (list(starts) or [allocate_greedy(slots, req_map, past_counts, random.Random(seed))])
+    best, best_cost = None, INFEASIBLE
+    for i, start in enumerate(starts):
+        # 残り時間を開始点で等分する
+        share = (deadline - clock()) / (len(starts) - i)
+        result = _improve(past_counts, slot_applicants, start, clock() + share, clock, rng)
+        # 探索の時間が無かったときも開始点そのものより悪くしない
+        for candidate in (result, start):
+            cost = schedule_cost(slots, req_map, past_counts, candidate)
+            if cost < best_cost: best, best_cost = dict(candidate), cost
+    return best
+
+
+def _assigned_by_student(schedule):
+    assigned = defaultdict(list)
+    for s, student in schedule.items(): assigned[student].append(s)
+    return assigned
+
+
+def _count_totals(slots, req_map, past_counts, assigned):
+    # 今回の枠がある学期ごとの、応募者の (過去 + 今回) 回数
+    totals = []
+    for sem in sorted({parse_slot(s).semester for s in slots}):
+        for student in req_map:
+            now = sum(1 for s in assigned[student] if parse_slot(s).semester == sem)
+            totals.append(past_counts.get((student, sem), 0) + now)
+    return totals
+
+
+def _variance(totals):
+    mean = sum(totals) / len(totals) if totals else 0
+    return sum((t - mean) ** 2 for t in totals) / len(totals) if totals else 0
+
+
+def _day_pairs(assigned):
+    # 戻り値: (同じ日の2枠の組数, そのうち連続しているもの)
+    pairs = contiguous = 0
+    for student, a in assigned.items():
+        by_day = defaultdict(list)
+        for s in a: by_day[parse_slot(s).date].append(parse_slot(s))
+        for day_slots in by_day.values():
+            if len(day_slots) == 2:
+                pairs += 1
+                x, y = sorted(day_slots, key=lambda i: i.sort_key)
+                if x.end == y.start: contiguous += 1
+    return pairs, contiguous
+
+
+def schedule_metrics(slots, req_map, past_counts, schedule):
+    # 充足率と公平性の指標 (貪欲法との比較表示用)
+    slot_applicants = build_slot_applicants(slots, req_map)
+    wanted = [s for s, c in slot_applicants.items() if c]
+    filled = [s for s in slots if s in schedule]
+    assigned = _assigned_by_student(schedule)
+
+    # 今回の枠がある学期ごとに、応募者の (過去 + 今回) 回数のばらつきを見る
+    totals = _count_totals(slots, req_map, past_counts, assigned)
+    pairs, contiguous = _day_pairs(assigned)
+
+    return {
+        "埋まった枠": len(filled),
+        "応募のある枠": len(wanted),
+        "充足率": len(filled) / len(wanted) if wanted else 1.0,
+        "回数の分散": _variance(totals),
+        "回数の最大差": (max(totals) - min(totals)) if totals else 0,
+        "0回の応募者": sum(1 for student in req_map if not assigned[student]),
+        "連続2枠": contiguous,
+        "離れた2枠": pairs - contiguous,
+        "コスト": schedule_cost(slots, req_map, past_counts, schedule),
+    }
+
+
+# --- 複数シードの貪欲法 (並列) ---
+# 乱数のシードだけを変えて貪欲法を制限時間いっぱい繰り返し、一番良い結果とそのシードを返す。
+# allocate_greedy(slots, req_map, past_counts, random.Random(seed)) で同じ結果を再現できる。
+
+def seed_score(slots, req_map, past_counts, schedule, wanted=None):
+    # 小さいほど良い: (埋まらない枠数, 回数の分散, -連続2枠)
+    if wanted is None: wanted = sum(1 for c in build_slot_applicants(slots, req_map).values() if c)
+    assigned = _assigned_by_student(schedule)
+    variance = _variance(_count_totals(slots, req_map, past_counts, assigned))
+    return (wanted - len(schedule), round(variance, 9), -_day_pairs(assigned)[1])
+
+
+def _seed_worker(slots, req_map, past_counts, first_seed, step, deadline):
+    # first_seed, first_seed + step, ... を deadline (time.time()) まで試す (最低1つ)
+    # 戻り値: (スコア, シード, 割り当て, 試した数)
+    wanted = sum(1 for c in build_slot_applicants(slots, req_map).values() if c)
+    best, tried, seed = None, 0, first_seed
+    while True:
+        schedule = allocate_greedy(slots, req_map, past_counts, random.Random(seed))
+        score = seed_score(slots, req_map, past_counts, schedule, wanted)
+        if best is None or (score, seed) < best[:2]: best = (score, seed, schedule)
+        tried += 1
+        seed += step
+        if time.time() >= deadline: break
+    return best + (tried,)
+
+
+def allocate_multi_seed(slots, req_map, past_counts, time_budget=2.0, workers=None, base_seed=0):
+    # 全コアで別々のシード列を試す (ワーカー i は base_seed + i から workers 個おき)
+    # 戻り値: (最良の {枠: 受講者}, そのシード, 試したシード数)
+    workers = workers or os.cpu_count() or 1
+    deadline = time.time() + time_budget
+    args = (list(slots), dict(req_map), Counter(past_counts))
+    results = None
+    if workers > 1:
+        # 学生画面の起動を重くしないよう、使うときだけ読み込む
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+        # スレッドが動いているサーバーのプロセスを fork しない (forkserver が無い環境では spawn)
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as pool:
+                futures = [pool.submit(_seed_worker, *args, base_seed + i, workers, deadline) for i in range(workers)]
+                results = [f.result() for f in futures]
+        except (OSError, NotImplementedError, BrokenProcessPool):
+            # プロセスを作れない・ワーカーが落ちたときはこのプロセスだけで回す
+            results = None
+    if results is None: results = [_seed_worker(*args, base_seed, 1, deadline)]
+    score, seed, schedule, _ = min(results, key=lambda r: r[:2])
+    return schedule, seed, sum(r[3] for r in results)
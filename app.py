@@ -1,524 +1,579 @@
+import os
 import streamlit as st
-import pandas as pd
-import random
-import re
 import unicodedata
+import uuid
 from datetime import datetime, timedelta
 from collections import defaultdict
-from supabase import create_client, Client
+from db import LessonDB, counts_crosstab
+from storage import create_backend
+from instrument import Profiler
+import random
+from allocator import (
+    allocate_greedy, allocate_optimal, allocate_multi_seed, past_counts_from_aggregate, schedule_metrics, UNFILLED,
+    changed_students, replan, schedule_diff,
+)
+from slot_utils import (
+    parse_slot, normalize_date_text, get_semester, sort_slots, group_continuous_slots,
+    WEEKDAYS, generate_recurring_slots, weekly_slot_counts, parse_holidays,
+)
 
 # --- 設定 ---
 st.set_page_config(page_title="レッスン調整システム", page_icon="🎹", layout="wide")
 st.title("🎹 レッスン日程 自動調整システム プロトタイプ")
 
-# --- Supabase接続 ---
+# --- DB接続 ---
+# 保存先は secrets の [storage] backend = "supabase" (既定) | "sqlite" で選ぶ。
+# secrets が無い環境では環境変数 LESSON_STORAGE=sqlite / LESSON_SQLITE_PATH でも指定できる。
+def storage_config():
+    try: secrets = st.secrets.to_dict()
+    except: secrets = {}
+    config = dict(secrets.get("storage", {}))
+    config.setdefault("backend", os.environ.get("LESSON_STORAGE", "supabase"))
+    if config["backend"] == "sqlite":
+        config.setdefault("path", os.environ.get("LESSON_SQLITE_PATH", "lesson_app.db"))
+    else:
+        config.setdefault("url", secrets["connections"]["supabase"]["SUPABASE_URL"])
+        config.setdefault("key", secrets["connections"]["supabase"]["SUPABASE_KEY"])
+    return config
+
+# 計測 (オプトイン): secrets の [profiling] enabled = true または環境変数 LESSON_PROFILE=1
+def profiling_enabled():
+    try: secrets = st.secrets.to_dict()
+    except: secrets = {}
+    if "profiling" in secrets: return bool(secrets["profiling"].get("enabled", False))
+    return os.environ.get("LESSON_PROFILE", "") not in ("", "0")
+
+@st.cache_resource
+def get_profiler():
+    return Profiler(enabled=profiling_enabled())
+
+# クライアントとテーブルキャッシュは全セッションで共有する
+@st.cache_resource
+def get_db():
+    return get_profiler().instrument(LessonDB(create_backend(storage_config())))
+
 try:
-    url = st.secrets["connections"]["supabase"]["SUPABASE_URL"]
-    key = st.secrets["connections"]["supabase"]["SUPABASE_KEY"]
-    supabase: Client = create_client(url, key)
+    db = get_db()
 except:
     st.error("Secretsの設定が間違っています。")
     st.stop()
 
-# --- 関数群 ---
-
-def normalize_date_text(text):
-    text = unicodedata.normalize('NFKC', text)
-    date_match = re.search(r'(\d{1,2})[\/\-月\.](\d{1,2})', text)
-    if not date_match: return text
-    month, day = int(date_match.group(1)), int(date_match.group(2))
-    now = datetime.now()
-    year = now.year
-    try: dt = datetime(year, month, day)
-    except: return text
-    weekdays = ["月", "火", "水", "木", "金", "土", "日"]
-    wk = weekdays[dt.weekday()]
-    date_str = f"{month}月{day}日({wk})"
-    time_match = re.search(r'(\d{1,2}[:：]\d{2})', text)
-    if time_match:
-        start_time_str = time_match.group(1).replace("：", ":")
-        range_match = re.search(r'(\d{1,2}[:：]\d{2})\s*[\-~〜]\s*(\d{1,2}[:：]\d{2})', text)
-        if range_match:
-            s_t = range_match.group(1).replace("：", ":")
-            e_t = range_match.group(2).replace("：", ":")
-            return f"{date_str} {s_t}-{e_t}"
-        else:
-            try:
-                st_obj = datetime.strptime(start_time_str, "%H:%M")
-                et_obj = st_obj + timedelta(minutes=50)
-                end_time_str = et_obj.strftime("%H:%M")
-                return f"{date_str} {start_time_str}-{end_time_str}"
-            except:
-                return f"{date_str} {start_time_str}"
-    return date_str
-
-def get_semester(date_str):
-    match = re.search(r'(\d{1,2})月', date_str)
-    if match:
-        if 4 <= int(match.group(1)) <= 8: return "前期"
-        else: return "後期"
-    return "不明"
-
-def sort_slots(slot_list):
-    def parse_key(s):
+profiler = get_profiler()
+st.session_state["_profile_rerun"] = profiler.start_rerun("page", st.session_state.get("_profile_rerun"))
+
+# 再実行ごとに版数を1回だけ確認し、変わったテーブルだけ読み直す
+db.refresh()
+
+def warn_if_incomplete(df_h):
+    # 件数確認: 取得できた履歴が DB の件数より少なければ知らせる
+    expected = df_h.attrs.get("expected_rows", len(df_h))
+    if len(df_h) < expected: st.warning(f"⚠️ 履歴の一部しか読み込めていません ({len(df_h)} / {expected}件)")
+
+def memo_map_of(request_rows):
+    return {name: r["memo"] for name, r in request_rows.items() if r["memo"]}
+
+def schedule_preview(slots, schedule, memo_map):
+    import pandas as pd
+    res = []
+    for s in sort_slots(slots):
+        winner = schedule.get(s, UNFILLED)
+        # メモがある場合は表示
+        memo_txt = ""
+        if winner != UNFILLED and winner in memo_map and memo_map[winner]:
+            memo_txt = f" ({memo_map[winner]})"
+        res.append({"日時": s, "受講者": winner + memo_txt, "学期": get_semester(s)})
+    return pd.DataFrame(res)
+
+def keep_draft(slots, schedule, req_map, previous, memo_map):
+    # 作成した割り当てを下書きとして保存し、前回の下書きとの差分と一緒にプレビューへ
+    db.save_draft(schedule, req_map)
+    st.session_state["preview"] = schedule_preview(slots, schedule, memo_map)
+    if previous: st.session_state["draft_diff"] = schedule_diff(slots, previous["schedule"], schedule)
+    else: st.session_state.pop("draft_diff", None)
+
+# --- 学生の希望フォーム ---
+# 日付ごとのブロックを fragment にして、チェックの切り替えではそのブロックだけ再実行する
+# (DBの読み込みやページ全体の再描画をしない)。
+
+def _toggle_all(wish_key, slots, widget_key):
+    wishes = st.session_state[wish_key]
+    if st.session_state[widget_key]: wishes.update(slots)
+    else: wishes.difference_update(slots)
+
+def _toggle_slot(wish_key, slot, widget_key):
+    wishes = st.session_state[wish_key]
+    if st.session_state[widget_key]: wishes.add(slot)
+    else: wishes.discard(slot)
+
+@st.fragment
+def wish_date_block(wish_key, d_key, slots):
+    wishes = st.session_state[wish_key]
+    with st.expander(f"📅 {d_key}", expanded=True):
+        # チェック状態は毎回 set から作る
+        all_key = f"all_{d_key}"
+        st.session_state[all_key] = all(s in wishes for s in slots)
+        st.checkbox(f"🙆‍♂️ {d_key} は何時でもOK", key=all_key,
+                    on_change=_toggle_all, args=(wish_key, slots, all_key))
+        if not st.session_state[all_key]:
+            for slot in slots:
+                chk_key = f"chk_{slot}"
+                st.session_state[chk_key] = slot in wishes
+                st.checkbox(slot.replace(d_key, "").strip(), key=chk_key,
+                            on_change=_toggle_slot, args=(wish_key, slot, chk_key))
+
+def session_token():
+    # このセッション (ブラウザのタブ) を表す値。送信キューが別の画面の送信をまとめないようにする
+    if "_session_token" not in st.session_state: st.session_state["_session_token"] = uuid.uuid4().hex
+    return st.session_state["_session_token"]
+
+@st.fragment
+def wish_submit_block(wish_key, student_name, current_slots, existing_memo):
+    memo_key, version_key, notice_key = f"memo_{student_name}", f"version_{student_name}", f"notice_{student_name}"
+    st.write("### 2. 備考 (任意)")
+    # ★新機能: メモ欄
+    memo_input = st.text_area("練習したい曲や、先生へのメッセージがあれば記入してください", value=existing_memo,
+                              height=100, key=memo_key)
+
+    st.markdown("---")
+    if notice_key in st.session_state:
+        st.session_state.pop(notice_key)
+        st.warning("⚠️ 別の画面から新しい希望が保存されていたため、今回の送信は保存していません。最新の内容を表示しています。")
+    if st.button("希望を送信する", type="primary"):
+        # 表示中の枠だけを、枠の並び順で保存する
+        position = {s: i for i, s in enumerate(current_slots)}
+        final_selected = sorted((s for s in st.session_state[wish_key] if s in position), key=position.__getitem__)
+        # 送信はキューでまとめて書かれ、保存後の行が返る (ページ全体は読み直さない)
         try:
-            match = re.search(r'(\d{1,2})月(\d{1,2})日.*?(\d{1,2}):(\d{2})', s)
-            if match:
-                mo, d, h, m = map(int, match.groups())
-                return (1 if mo <= 3 else 0, mo, d, h, m)
-            return (99, 99, 99, 99, 99)
-        except: return (99, 99, 99, 99, 99)
-    return sorted(slot_list, key=parse_key)
-
-def group_continuous_slots(sorted_slots):
-    if not sorted_slots: return []
-    grouped_by_date = defaultdict(list)
-    for s in sorted_slots:
-        d_part = s.split(" ")[0]
-        t_part = s.split(" ")[1] if " " in s else ""
-        grouped_by_date[d_part].append(t_part)
-    summary_list = []
-    for date_key, times in grouped_by_date.items():
-        if not times: continue
-        current_start, current_end = None, None
-        count = 0
-        def parse_range(t_str):
-            try: return t_str.split("-")
-            except: return None, None
-        for t in times:
-            s, e = parse_range(t)
-            if not s: continue 
-            if current_start is None:
-                current_start, current_end = s, e
-                count = 1
-            else:
-                if current_end == s:
-                    current_end = e
-                    count += 1
-                else:
-                    summary_list.append(f"{date_key} {current_start}〜{current_end} ({count}枠)")
-                    current_start, current_end = s, e
-                    count = 1
-        if current_start:
-            summary_list.append(f"{date_key} {current_start}〜{current_end} ({count}枠)")
-    return summary_list
-
-# --- DB操作 (Supabase) ---
-
-def load_slots():
-    response = supabase.table("slots").select("date_text").execute()
-    return [item['date_text'] for item in response.data]
-
-def save_slots(slot_list):
-    normalized_list = [normalize_date_text(s) for s in slot_list]
-    unique_list = sorted(list(set(normalized_list)), key=lambda s: sort_slots([s])[0])
-    supabase.table("slots").delete().neq("id", 0).execute() 
-    if unique_list:
-        data = [{"date_text": s} for s in unique_list]
-        supabase.table("slots").insert(data).execute()
-
-def load_requests():
-    response = supabase.table("requests").select("*").execute()
-    if not response.data: return pd.DataFrame(columns=["氏名", "希望枠", "メモ"])
-    df = pd.DataFrame(response.data)
-    # カラム名マッピング (memoがない場合も考慮)
-    rename_map = {"student_name": "氏名", "wishes": "希望枠"}
-    if "memo" in df.columns: rename_map["memo"] = "メモ"
-    else: df["メモ"] = ""
-    return df.rename(columns=rename_map)
-
-def save_requests_row(name, wishes_str, memo_str):
-    data = {"student_name": name, "wishes": wishes_str, "memo": memo_str}
-    supabase.table("requests").upsert(data, on_conflict="student_name").execute()
-
-def load_history():
-    response = supabase.table("history").select("*").execute()
-    if not response.data: return pd.DataFrame(columns=["日時", "受講者", "学期"])
-    df = pd.DataFrame(response.data)
-    return df.rename(columns={"date_text": "日時", "student_name": "受講者", "semester": "学期"})
-
-def save_history_new(df_new):
-    if df_new.empty: return
-    data = []
-    for _, row in df_new.iterrows():
-        data.append({
-            "date_text": row["日時"],
-            "student_name": row["受講者"],
-            "semester": row["学期"]
-        })
-    supabase.table("history").insert(data).execute()
-
-def load_students():
-    response = supabase.table("students").select("name").execute()
-    return [item['name'] for item in response.data]
-
-def save_students(name_list):
-    name_list = sorted(list(set(name_list)))
-    supabase.table("students").delete().neq("id", 0).execute()
-    if name_list:
-        data = [{"name": n} for n in name_list]
-        supabase.table("students").insert(data).execute()
-
-# ★募集スイッチの読み書き
-def get_is_open():
-    try:
-        res = supabase.table("app_settings").select("is_open").eq("id", 1).execute()
-        if res.data: return res.data[0]["is_open"]
-        return True
-    except: return True
-
-def set_is_open(status: bool):
-    supabase.table("app_settings").upsert({"id": 1, "is_open": status}).execute()
+            saved = db.submit_request(student_name, final_selected, memo_input, st.session_state.get(version_key, 0),
+                                      session_token())
+        except:
+            # 通信エラーなど: 画面の選択はそのまま残し、もう一度送ってもらう
+            st.error("⚠️ 保存できませんでした。時間をおいて、もう一度送信してください。")
+            return
+        st.session_state[version_key] = saved["version"]
+        st.session_state[wish_key] = set(saved["wishes"])
+        if saved["ok"]:
+            st.success(f"✅ 保存しました！ (希望 {len(saved['wishes'])}枠)")
+        else:
+            # 他の画面の新しい内容で、日付ブロックとメモ欄も含めて描き直す
+            st.session_state.pop(memo_key, None)
+            st.session_state[notice_key] = True
+            st.rerun()
 
 # --- 画面構成 ---
-tab1, tab2, tab3 = st.tabs(["🙋 学生用", "📅 先生用 (登録・管理)", "📊 データ集計"])
+# 開いているタブだけを描き、そのタブが使う一覧だけを読む
+# (学生タブの再実行では管理画面の表を作らず、pandas も読み込まない)
+TAB_LABELS = ["🙋 学生用", "📅 先生用 (登録・管理)", "📊 データ集計"]
+try: tab1, tab2, tab3 = st.tabs(TAB_LABELS, key="main_tabs", on_change="rerun")
+except TypeError: tab1, tab2, tab3 = st.tabs(TAB_LABELS)  # 古い streamlit では全タブを描く
+
+def is_shown(tab):
+    # 開いているか分からない (古い streamlit) ときは描く
+    return getattr(tab, "open", None) is not False
+
+fields = set()
+if is_shown(tab1) and db.get_is_open(): fields.update(("slots", "students", "request_rows"))
+if is_shown(tab2): fields.update(("slots", "students", "request_rows", "slot_demand", "history_counts", "draft"))
+if is_shown(tab3): fields.add("history")
+# 使う一覧はここで並行して読み、snap として渡す
+snap = db.snapshot(fields)
 
 # ==========================================
 # タブ1: 学生用 (スマホ最適化)
 # ==========================================
-with tab1:
-    st.header("レッスン希望の提出")
+if is_shown(tab1):
+    with tab1, profiler.section("tab1"):
+        st.header("レッスン希望の提出")
     
-    # ★募集停止チェック
-    is_open = get_is_open()
+        # ★募集停止チェック
+        is_open = snap.is_open
     
-    if not is_open:
-        st.error("⛔ 現在、レッスン希望の受付は停止しています。")
-        st.info("日程調整中、または締め切り後です。先生からの連絡をお待ちください。")
+        if not is_open:
+            st.error("⛔ 現在、レッスン希望の受付は停止しています。")
+            st.info("日程調整中、または締め切り後です。先生からの連絡をお待ちください。")
         
-        # 停止中でも「確定した日程」だけは見れるようにする
-        raw_slots = load_slots()
-        student_list = load_students()
-        if student_list:
-            val = st.selectbox("氏名を選択して予定を確認", ["(選択してください)"] + student_list, key="std_check")
-            if val != "(選択してください)":
-                df_h = load_history()
-                if not df_h.empty:
-                    my_lessons = df_h[df_h["受講者"] == val]
-                    if not my_lessons.empty:
+            # 停止中でも「確定した日程」だけは見れるようにする
+            # (名簿と全員の確定レッスンをまとめた1つの文書から表示し、テーブルは読まない)
+            closed_view = db.load_closed_view()
+            student_list = closed_view["students"]
+            if student_list:
+                val = st.selectbox("氏名を選択して予定を確認", ["(選択してください)"] + student_list, key="std_check")
+                if val != "(選択してください)":
+                    my_lessons = closed_view["lessons"].get(val, [])
+                    if my_lessons:
                         st.write("##### ✅ あなたの確定レッスン")
-                        my_lessons["sort_key"] = my_lessons["日時"].apply(lambda x: sort_slots([x])[0])
-                        my_lessons = my_lessons.sort_values("sort_key")
-                        for _, row in my_lessons.iterrows():
-                            st.success(f"{row['日時']}")
+                        for d in my_lessons:
+                            st.success(f"{d}")
                     else: st.info("確定したレッスンはありません。")
     
-    else:
-        # 募集中
-        raw_slots = load_slots()
-        student_list = load_students()
-        
-        if not raw_slots:
-            st.warning("現在、募集中のレッスン枠はありません。")
         else:
-            current_slots = sort_slots(raw_slots)
-            df_req = load_requests()
-            
-            student_name = ""
-            if not student_list:
-                st.error("名簿が登録されていません。")
+            # 募集中
+            raw_slots = snap.slots
+            student_list = snap.students
+        
+            if not raw_slots:
+                st.warning("現在、募集中のレッスン枠はありません。")
             else:
-                val = st.selectbox("氏名を選択", ["(選択してください)"] + student_list)
-                if val != "(選択してください)": student_name = val
-
-            if student_name:
-                # 確定確認
-                with st.expander("📅 あなたの確定済みレッスンを確認する"):
-                    df_h = load_history()
-                    if not df_h.empty:
-                        my_lessons = df_h[df_h["受講者"] == student_name]
-                        if not my_lessons.empty:
-                            my_lessons["sort_key"] = my_lessons["日時"].apply(lambda x: sort_slots([x])[0])
-                            my_lessons = my_lessons.sort_values("sort_key")
-                            for _, row in my_lessons.iterrows():
-                                st.success(f"✅ {row['日時']}")
+                current_slots = raw_slots
+                request_rows = snap.request_rows
+            
+                student_name = ""
+                if not student_list:
+                    st.error("名簿が登録されていません。")
+                else:
+                    val = st.selectbox("氏名を選択", ["(選択してください)"] + student_list)
+                    if val != "(選択してください)": student_name = val
+
+                if student_name:
+                    # 確定確認
+                    with st.expander("📅 あなたの確定済みレッスンを確認する"):
+                        my_lessons = db.load_student_lessons(student_name)
+                        if my_lessons:
+                            for d in my_lessons:
+                                st.success(f"✅ {d}")
                         else: st.info("まだありません。")
 
-                st.markdown("---")
+                    st.markdown("---")
                 
-                # 既存データ読み込み
-                existing_wishes = []
-                existing_memo = ""
-                if not df_req.empty and student_name in df_req["氏名"].values:
-                    row = df_req[df_req["氏名"] == student_name].iloc[0]
-                    if pd.notna(row["希望枠"]) and row["希望枠"]:
-                        existing_wishes = row["希望枠"].split(",")
-                    if "メモ" in row and pd.notna(row["メモ"]):
-                        existing_memo = row["メモ"]
+                    # 既存データ読み込み
+                    existing_wishes = db.load_student_wishes(student_name)
+                    row = request_rows.get(student_name, {})
+                    existing_memo = row.get("memo", "")
+                    existing_version = row.get("version", 0)
                 
-                slots_by_date = defaultdict(list)
-                for slot in current_slots:
-                    d_key = slot.split(" ")[0]
-                    slots_by_date[d_key].append(slot)
+                    # 希望は学生ごとに set で持ち、日付ブロック単位で更新する
+                    # (読み込んだときの版数も持っておき、送信時に古い画面でないか確かめる)
+                    wish_key = f"wishes_{student_name}"
+                    if wish_key not in st.session_state:
+                        st.session_state[wish_key] = set(existing_wishes)
+                        st.session_state[f"version_{student_name}"] = existing_version
+
+                    slots_by_date = defaultdict(list)
+                    for slot in current_slots:
+                        slots_by_date[parse_slot(slot).date].append(slot)
 
-                with st.form("student_form"):
                     st.write("### 1. 希望日時を選択")
-                    final_selected = []
                     for d_key, slots in slots_by_date.items():
-                        with st.expander(f"📅 {d_key}", expanded=True):
-                            all_checked = all(s in existing_wishes for s in slots)
-                            if st.checkbox(f"🙆‍♂️ {d_key} は何時でもOK", value=all_checked, key=f"all_{d_key}"):
-                                final_selected.extend(slots)
-                            else:
-                                for slot in slots:
-                                    label = slot.replace(d_key, "").strip()
-                                    is_on = slot in existing_wishes
-                                    if st.checkbox(label, value=is_on, key=f"chk_{slot}"):
-                                        final_selected.append(slot)
-                    
-                    st.write("### 2. 備考 (任意)")
-                    # ★新機能: メモ欄
-                    memo_input = st.text_area("練習したい曲や、先生へのメッセージがあれば記入してください", value=existing_memo, height=100)
-                    
-                    st.markdown("---")
-                    if st.form_submit_button("希望を送信する", type="primary"):
-                        final_selected = sorted(list(set(final_selected)), key=lambda s: current_slots.index(s) if s in current_slots else 999)
-                        wishes_str = ",".join(final_selected)
-                        save_requests_row(student_name, wishes_str, memo_input)
-                        st.success("✅ 保存しました！")
-                        st.rerun()
+                        wish_date_block(wish_key, d_key, slots)
+
+                    wish_submit_block(wish_key, student_name, current_slots, existing_memo)
 
 # ==========================================
 # タブ2: 先生用
 # ==========================================
-with tab2:
-    st.header("管理者メニュー")
+if is_shown(tab2):
+    with tab2, profiler.section("tab2"):
+        # 管理画面の表だけが pandas を使う
+        import pandas as pd
+        st.header("管理者メニュー")
     
-    # ★新機能: 募集スイッチ
-    st.subheader("📢 募集ステータス")
-    is_open = get_is_open()
-    c_sw1, c_sw2 = st.columns([1, 3])
-    with c_sw1:
-        if is_open:
-            st.success("🟢 現在：募集中")
-            if st.button("⛔ 募集を停止する"):
-                set_is_open(False)
-                st.rerun()
-        else:
-            st.error("🔴 現在：停止中")
-            if st.button("🟢 募集を開始する"):
-                set_is_open(True)
-                st.rerun()
-    with c_sw2:
-        st.caption("「停止中」にすると、学生は希望を送信できなくなります（日程調整中などに使います）。")
+        # ★新機能: 募集スイッチ
+        st.subheader("📢 募集ステータス")
+        is_open = snap.is_open
+        c_sw1, c_sw2 = st.columns([1, 3])
+        with c_sw1:
+            if is_open:
+                st.success("🟢 現在：募集中")
+                if st.button("⛔ 募集を停止する"):
+                    db.set_is_open(False)
+                    st.rerun()
+            else:
+                st.error("🔴 現在：停止中")
+                if st.button("🟢 募集を開始する"):
+                    db.set_is_open(True)
+                    st.rerun()
+        with c_sw2:
+            st.caption("「停止中」にすると、学生は希望を送信できなくなります（日程調整中などに使います）。")
 
-    st.markdown("---")
+        st.markdown("---")
 
-    with st.expander("📊 半期ごとのレッスン回数", expanded=False):
-        df_h = load_history()
-        if not df_h.empty:
-            count_table = pd.crosstab(df_h["受講者"], df_h["学期"], margins=True, margins_name="合計")
-            st.dataframe(count_table, use_container_width=True)
-        else: st.info("履歴なし")
+        with st.expander("📊 半期ごとのレッスン回数", expanded=False):
+            df_counts = snap.history_counts
+            if not df_counts.empty:
+                st.dataframe(counts_crosstab(df_counts), use_container_width=True)
+            else: st.info("履歴なし")
 
-    st.markdown("---")
-    st.subheader("📝 登録済みリスト")
-    current_slots = sort_slots(load_slots())
+        st.markdown("---")
+        st.subheader("📝 登録済みリスト")
+        current_slots = snap.slots
+    
+        if current_slots:
+            summary = group_continuous_slots(current_slots)
+            for s in summary:
+                st.info(f"**{s}**")
+            with st.expander("詳細リストの編集・削除"):
+                demand = snap.slot_demand
+                for slot in current_slots:
+                    col_txt, col_del = st.columns([4, 1])
+                    col_txt.text(f"･ {slot}  (応募数: {demand.get(slot, 0)})")
+                    if col_del.button("削除", key=f"del_{slot}"):
+                        db.remove_slots([slot])
+                        st.rerun()
+                if st.button("全削除", type="primary"):
+                    db.reset_slots(); st.rerun()
+        else: st.info("登録なし")
+
+        st.markdown("---")
+        st.subheader("🪄 日程の一括作成 (50分連続枠)")
+        c1, c2, c3 = st.columns(3)
+        gen_date = c1.text_input("日付 (例: 9/11)", value="9/11")
+        gen_start = c2.text_input("開始 (例: 10:00)", value="10:00")
+        gen_end = c3.text_input("終了 (例: 13:00)", value="13:00")
     
-    if current_slots:
-        summary = group_continuous_slots(current_slots)
-        for s in summary:
-            st.info(f"**{s}**")
-        with st.expander("詳細リストの編集・削除"):
-            for slot in current_slots:
-                col_txt, col_del = st.columns([4, 1])
-                col_txt.text(f"･ {slot}")
-                if col_del.button("削除", key=f"del_{slot}"):
-                    new_list = [s for s in current_slots if s != slot]
-                    save_slots(new_list)
+        if st.button("プランを計算"):
+            try:
+                clean_date = normalize_date_text(gen_date).split(" ")[0]
+                clean_start = unicodedata.normalize('NFKC', gen_start).replace("：", ":")
+                clean_end = unicodedata.normalize('NFKC', gen_end).replace("：", ":")
+                dummy = datetime(2000, 1, 1)
+                t_s = datetime.strptime(clean_start, "%H:%M")
+                t_e = datetime.strptime(clean_end, "%H:%M")
+                plan_a = []
+                curr = datetime.combine(dummy, t_s.time())
+                limit = datetime.combine(dummy, t_e.time())
+                while curr + timedelta(minutes=50) <= limit:
+                    nxt = curr + timedelta(minutes=50)
+                    plan_a.append(f"{clean_date} {curr.strftime('%H:%M')}-{nxt.strftime('%H:%M')}")
+                    curr = nxt
+                plan_b = []
+                curr = datetime.combine(dummy, t_s.time())
+                while curr < limit:
+                    nxt = curr + timedelta(minutes=50)
+                    plan_b.append(f"{clean_date} {curr.strftime('%H:%M')}-{nxt.strftime('%H:%M')}")
+                    curr = nxt
+                st.session_state["p_a"], st.session_state["p_b"] = plan_a, plan_b
+                st.session_state["gen_info"] = f"{clean_date} {clean_start}〜{clean_end}"
+            except: st.error("時間を正しく入力してください")
+
+        if "p_a" in st.session_state:
+            st.info(f"📅 **{st.session_state['gen_info']}** の提案")
+            ca, cb = st.columns(2)
+            with ca:
+                st.markdown(f"### 🅰️ 時間内 ({len(st.session_state['p_a'])}枠)")
+                for s in st.session_state['p_a']: st.text(f"･ {s}")
+                if st.button("🅰️ 追加", key="btn_a"):
+                    added = db.add_slots(st.session_state['p_a'])
+                    st.success(f"追加しました ({added}枠)")
+                    del st.session_state['p_a'], st.session_state['p_b']
+                    st.rerun()
+            with cb:
+                st.markdown(f"### 🅱️ 使い切り ({len(st.session_state['p_b'])}枠)")
+                for s in st.session_state['p_b']:
+                    if s not in st.session_state['p_a']: st.markdown(f"**･ {s} (延長)**")
+                    else: st.text(f"･ {s}")
+                if st.button("🅱️ 追加", key="btn_b"):
+                    added = db.add_slots(st.session_state['p_b'])
+                    st.success(f"追加しました ({added}枠)")
+                    del st.session_state['p_a'], st.session_state['p_b']
                     st.rerun()
-            if st.button("全削除", type="primary"):
-                save_slots([]); st.rerun()
-    else: st.info("登録なし")
 
-    st.markdown("---")
-    st.subheader("🪄 日程の一括作成 (50分連続枠)")
-    c1, c2, c3 = st.columns(3)
-    gen_date = c1.text_input("日付 (例: 9/11)", value="9/11")
-    gen_start = c2.text_input("開始 (例: 10:00)", value="10:00")
-    gen_end = c3.text_input("終了 (例: 13:00)", value="13:00")
-    
-    if st.button("プランを計算"):
-        try:
-            clean_date = normalize_date_text(gen_date).split(" ")[0]
-            clean_start = unicodedata.normalize('NFKC', gen_start).replace("：", ":")
-            clean_end = unicodedata.normalize('NFKC', gen_end).replace("：", ":")
-            dummy = datetime(2000, 1, 1)
-            t_s = datetime.strptime(clean_start, "%H:%M")
-            t_e = datetime.strptime(clean_end, "%H:%M")
-            plan_a = []
-            curr = datetime.combine(dummy, t_s.time())
-            limit = datetime.combine(dummy, t_e.time())
-            while curr + timedelta(minutes=50) <= limit:
-                nxt = curr + timedelta(minutes=50)
-                plan_a.append(f"{clean_date} {curr.strftime('%H:%M')}-{nxt.strftime('%H:%M')}")
-                curr = nxt
-            plan_b = []
-            curr = datetime.combine(dummy, t_s.time())
-            while curr < limit:
-                nxt = curr + timedelta(minutes=50)
-                plan_b.append(f"{clean_date} {curr.strftime('%H:%M')}-{nxt.strftime('%H:%M')}")
-                curr = nxt
-            st.session_state["p_a"], st.session_state["p_b"] = plan_a, plan_b
-            st.session_state["gen_info"] = f"{clean_date} {clean_start}〜{clean_end}"
-        except: st.error("時間を正しく入力してください")
-
-    if "p_a" in st.session_state:
-        st.info(f"📅 **{st.session_state['gen_info']}** の提案")
-        ca, cb = st.columns(2)
-        with ca:
-            st.markdown(f"### 🅰️ 時間内 ({len(st.session_state['p_a'])}枠)")
-            for s in st.session_state['p_a']: st.text(f"･ {s}")
-            if st.button("🅰️ 追加", key="btn_a"):
-                current = load_slots()
-                save_slots(current + st.session_state['p_a'])
-                st.success("追加しました")
-                del st.session_state['p_a'], st.session_state['p_b']
-                st.rerun()
-        with cb:
-            st.markdown(f"### 🅱️ 使い切り ({len(st.session_state['p_b'])}枠)")
-            for s in st.session_state['p_b']:
-                if s not in st.session_state['p_a']: st.markdown(f"**･ {s} (延長)**")
-                else: st.text(f"･ {s}")
-            if st.button("🅱️ 追加", key="btn_b"):
-                current = load_slots()
-                save_slots(current + st.session_state['p_b'])
-                st.success("追加しました")
-                del st.session_state['p_a'], st.session_state['p_b']
+        st.markdown("---")
+        with st.expander("🗓️ 学期分の繰り返し枠を一括作成"):
+            c1, c2 = st.columns(2)
+            today = datetime.now().date()
+            rec_start = c1.date_input("開始日", value=today, key="rec_start")
+            rec_end = c2.date_input("終了日", value=today + timedelta(days=111), key="rec_end")
+            rec_days = st.multiselect("曜日", list(range(7)), default=[0], format_func=lambda i: WEEKDAYS[i], key="rec_days")
+            c3, c4, c5 = st.columns(3)
+            rec_from = c3.time_input("開始", value=datetime.strptime("10:00", "%H:%M").time(), key="rec_from")
+            rec_to = c4.time_input("終了", value=datetime.strptime("13:00", "%H:%M").time(), key="rec_to")
+            rec_len = c5.number_input("1コマ (分)", min_value=10, max_value=180, value=50, step=5, key="rec_len")
+            rec_overflow = st.radio("終了時刻の扱い", ["🅰️ 時間内", "🅱️ 使い切り"], horizontal=True, key="rec_overflow") == "🅱️ 使い切り"
+            rec_holidays = st.text_area("休講日 (例: 9/23, 2025-10-13)", key="rec_holidays")
+
+            if st.button("プレビュー", key="rec_preview"):
+                try:
+                    holidays = parse_holidays(rec_holidays, rec_start, rec_end)
+                    st.session_state["rec_plan"] = generate_recurring_slots(
+                        rec_start, rec_end, rec_days, rec_from, rec_to, int(rec_len), holidays, rec_overflow)
+                except ValueError as e: st.error(f"休講日を読み取れません: {e}")
+
+            if "rec_plan" in st.session_state:
+                df_plan = st.session_state["rec_plan"]
+                if df_plan.empty: st.warning("条件に合う枠がありません")
+                else:
+                    existing = set(snap.slots)
+                    new_count = int((~df_plan["枠"].isin(existing)).sum())
+                    st.info(f"📅 {len(df_plan)}枠 (うち新規 {new_count}枠)")
+                    st.dataframe(weekly_slot_counts(df_plan), hide_index=True, use_container_width=True)
+                    if st.button("一括追加", type="primary", key="rec_add"):
+                        added = db.add_slots(df_plan["枠"].tolist(), normalize=False)
+                        del st.session_state["rec_plan"]
+                        st.success(f"追加しました ({added}枠)")
+                        st.rerun()
+
+        st.markdown("---")
+        with st.expander("【方法B】リストを直接編集"):
+            st.info("💡 「9/11 10:00」で自動補正されます。")
+            current_slots_text = "\n".join(snap.slots)
+            edited_text = st.text_area("編集エリア", value=current_slots_text, height=200)
+            if st.button("上書き保存", type="primary"):
+                lines = [l.strip() for l in edited_text.split('\n') if l.strip()]
+                added, removed = db.save_slots(lines)
+                st.success(f"保存しました！ (追加 {added} / 削除 {removed})")
                 st.rerun()
 
-    st.markdown("---")
-    with st.expander("【方法B】リストを直接編集"):
-        st.info("💡 「9/11 10:00」で自動補正されます。")
-        current_slots_text = "\n".join(load_slots())
-        edited_text = st.text_area("編集エリア", value=current_slots_text, height=200)
-        if st.button("上書き保存", type="primary"):
-            lines = [l.strip() for l in edited_text.split('\n') if l.strip()]
-            save_slots(lines)
-            st.success("保存しました！")
-            st.rerun()
+        st.markdown("---")
+        with st.expander("👥 名簿編集"):
+            cur_std = snap.students
+            txt = st.text_area("リスト", "\n".join(cur_std))
+            if st.button("名簿保存"):
+                added, removed = db.save_students([x.strip() for x in txt.split('\n') if x.strip()])
+                st.success(f"保存しました (追加 {added} / 削除 {removed})"); st.rerun()
+
+        c_mode1, c_mode2 = st.columns([2, 1])
+        alloc_mode = c_mode1.radio("割り当て方法", ["貪欲法 (従来)", "複数シード", "最適化"], horizontal=True,
+                                   help="複数シード: 乱数を変えた貪欲法を全コアで繰り返し、❌が最も少ない結果を選びます / "
+                                        "最適化: 埋まる枠数と回数の偏りを全体で最適化します（どちらも貪欲法との比較を表示）")
+        if alloc_mode == "貪欲法 (従来)":
+            seed_text = c_mode2.text_input("シード (空欄でランダム)", help="複数シードで表示されたシードを入れると同じ結果を再現できます")
+        else:
+            time_budget = c_mode2.number_input("計算時間の上限 (秒)", min_value=0.5, max_value=60.0, value=3.0, step=0.5)
 
-    st.markdown("---")
-    with st.expander("👥 名簿編集"):
-        cur_std = load_students()
-        txt = st.text_area("リスト", "\n".join(cur_std))
-        if st.button("名簿保存"):
-            save_students([x.strip() for x in txt.split('\n') if x.strip()])
-            st.success("保存しました"); st.rerun()
-
-    if st.button("🤖 シフト作成 (連続2枠優先)"):
-        current_slots = load_slots()
-        df_req = load_requests()
-        df_hist = load_history()
+        if st.button("🤖 シフト作成 (連続2枠優先)"):
+            current_slots = snap.slots
+            req_map = db.load_wishes()
+            df_counts = snap.history_counts
         
-        if df_req.empty or not current_slots: st.error("データ不足")
-        else:
-            req_map = {}
-            # メモも取得
-            memo_map = {}
-            for _, r in df_req.iterrows():
-                if pd.notna(r["希望枠"]) and r["希望枠"]:
-                    req_map[r["氏名"]] = r["希望枠"].split(",")
-                if "メモ" in r and pd.notna(r["メモ"]):
-                    memo_map[r["氏名"]] = r["メモ"]
-
-            slot_applicants = {s: [] for s in current_slots}
-            for name, wishes in req_map.items():
-                for w in wishes:
-                    if w in current_slots: slot_applicants[w].append(name)
-            
-            final_schedule = {}
-            current_batch_counts = defaultdict(int)
-            daily_counts = defaultdict(lambda: defaultdict(int))
-            daily_last_end = defaultdict(lambda: defaultdict(str))
-            
-            sorted_slots_process = sort_slots(current_slots)
-
-            for slot in sorted_slots_process:
-                cands = slot_applicants[slot]
-                if not cands: continue
-
-                semester = get_semester(slot)
-                match_dt = re.match(r'(.*?)\s*(\d{1,2}:\d{2})-(\d{1,2}:\d{2})', slot)
-                if match_dt: date_part, s_time, e_time = match_dt.groups()
-                else: date_part, s_time, e_time = slot.split(" ")[0], "00:00", "00:00"
-
-                scored_cands = []
-                for student in cands:
-                    if daily_counts[student][date_part] >= 2: continue
-                    past_count = len(df_hist[ (df_hist["受講者"]==student) & (df_hist["学期"]==semester) ])
-                    total_count = past_count + current_batch_counts[student]
-                    penalty = 0
-                    if daily_counts[student][date_part] == 1:
-                        prev_end = daily_last_end[student][date_part]
-                        if prev_end == s_time: penalty = -50 
-                        else: penalty = 999 
-                    score = total_count + penalty
-                    scored_cands.append( (score, random.random(), student) )
-                
-                if scored_cands:
-                    scored_cands.sort()
-                    winner = scored_cands[0][2]
-                    final_schedule[slot] = winner
-                    current_batch_counts[winner] += 1
-                    daily_counts[winner][date_part] += 1
-                    daily_last_end[winner][date_part] = e_time
-            
-            res = []
-            for s in sort_slots(current_slots):
-                winner = final_schedule.get(s, "❌")
-                # メモがある場合は表示
-                memo_txt = ""
-                if winner != "❌" and winner in memo_map and memo_map[winner]:
-                    memo_txt = f" ({memo_map[winner]})"
-                    
-                res.append({"日時": s, "受講者": winner + memo_txt, "学期": get_semester(s)})
-                
-            st.session_state["preview"] = pd.DataFrame(res)
+            if not req_map or not current_slots: st.error("データ不足")
+            else:
+                # メモも取得
+                memo_map = memo_map_of(snap.request_rows)
+
+                past_counts = past_counts_from_aggregate(df_counts)
+                rng = random
+                if alloc_mode == "貪欲法 (従来)" and seed_text.strip():
+                    try: rng = random.Random(int(seed_text))
+                    except ValueError: st.warning("シードは整数で入力してください (ランダムで作成します)")
+                with profiler.section("allocate_greedy"):
+                    final_schedule = allocate_greedy(current_slots, req_map, past_counts, rng)
+                if alloc_mode != "貪欲法 (従来)":
+                    greedy_schedule = final_schedule
+                    if alloc_mode == "複数シード":
+                        with st.spinner("複数のシードで試しています..."), profiler.section("allocate_multi_seed"):
+                            final_schedule, best_seed, tried = allocate_multi_seed(
+                                current_slots, req_map, past_counts, time_budget=time_budget)
+                        st.info(f"🎲 最良のシード: **{best_seed}** ({tried}通り試行) — 貪欲法でこのシードを指定すると同じ結果になります")
+                    else:
+                        with st.spinner("最適化中..."), profiler.section("allocate_optimal"):
+                            final_schedule = allocate_optimal(current_slots, req_map, past_counts, time_budget=time_budget,
+                                                          starts=[greedy_schedule])
+                    st.write("#### ⚖️ 貪欲法との比較")
+                    compare = {}
+                    for label, sched in [("貪欲法", greedy_schedule), (alloc_mode, final_schedule)]:
+                        m = schedule_metrics(current_slots, req_map, past_counts, sched)
+                        m["充足率"] = f"{m['充足率']:.0%}"
+                        m["回数の分散"] = f"{m['回数の分散']:.2f}"
+                        compare[label] = {k: str(v) for k, v in m.items()}
+                    st.table(pd.DataFrame(compare))
+
+                keep_draft(current_slots, final_schedule, req_map, snap.draft, memo_map)
+                snap = snap._replace(draft=db.load_draft())
+
+        # --- 下書き (サーバーに保存され、再読み込みしても残る) ---
+        draft = snap.draft
+        if draft:
+            if "preview" not in st.session_state:
+                st.session_state["preview"] = schedule_preview(snap.slots, draft["schedule"], memo_map_of(snap.request_rows))
+            draft_time = datetime.fromisoformat(draft["created_at"]).astimezone().strftime("%m/%d %H:%M")
+            with st.expander(f"🔁 下書きから変更分だけ再計算 (下書き: {draft_time})"):
+                req_now = db.load_wishes()
+                changed = changed_students(draft["wishes"], req_now)
+                st.caption("下書きの後に希望が変わった学生: " + ("、".join(changed) if changed else "なし"))
+                extra = st.multiselect("他にも組み直す学生", [n for n in snap.students if n not in changed])
+                st.caption("この学生たちの枠と空き枠・新しい枠だけを組み直し、他の割り当ては動かしません。")
+                if st.button("変更分だけ再計算"):
+                    past_counts = past_counts_from_aggregate(snap.history_counts)
+                    with profiler.section("replan"):
+                        new_schedule, affected = replan(snap.slots, req_now, past_counts, draft["schedule"], changed + extra)
+                    keep_draft(snap.slots, new_schedule, req_now, draft, memo_map_of(snap.request_rows))
+                    snap = snap._replace(draft=db.load_draft())
+                    st.success(f"{len(affected)}枠を組み直しました")
+
+        if "preview" in st.session_state:
+            if "draft_diff" in st.session_state:
+                diff = st.session_state["draft_diff"]
+                if diff:
+                    st.write(f"#### 🔀 前回の下書きとの差分 ({len(diff)}枠)")
+                    st.table(pd.DataFrame(diff, columns=["日時", "前回", "今回"]))
+                else: st.info("前回の下書きから変更はありません")
             st.table(st.session_state["preview"])
-            
+
             if not st.session_state["preview"].empty:
                 st.write("#### 📋 LINE貼り付け用テキスト")
                 copy_text = "【レッスン日程】\n"
                 for _, row in st.session_state["preview"].iterrows():
                     # ❌以外を表示
-                    if "❌" not in row["受講者"]:
+                    if UNFILLED not in row["受講者"]:
                         copy_text += f"{row['日時']} : {row['受講者']}\n"
                 st.code(copy_text, language="text")
 
-    if "preview" in st.session_state:
-        if st.button("確定して履歴に保存"):
-            # 履歴保存時はメモを除去して名前だけにする
-            to_save = st.session_state["preview"].copy()
-            # "松村泰佑 (曲名)" -> "松村泰佑" に戻す処理
-            to_save["受講者"] = to_save["受講者"].apply(lambda x: x.split(" (")[0])
+            if st.button("確定して履歴に保存"):
+                # 履歴保存時はメモを除去して名前だけにする
+                to_save = st.session_state["preview"].copy()
+                # "松村泰佑 (曲名)" -> "松村泰佑" に戻す処理
+                to_save["受講者"] = to_save["受講者"].apply(lambda x: x.split(" (")[0])
             
-            to_save = to_save[ to_save["受講者"].str.contains("❌") == False ]
-            save_history_new(to_save)
-            st.success("保存完了！")
-            del st.session_state["preview"]
+                to_save = to_save[ to_save["受講者"].str.contains(UNFILLED) == False ]
+                db.save_history_new(to_save)
+                # この再実行の後半 (タブ3) でも保存後の履歴を見せる
+                if is_shown(tab3): snap = snap._replace(history=db.load_history(), history_counts=db.load_history_counts())
+                # 確定した下書きは消す (次の調整は新しく作る)
+                db.reset_drafts()
+                st.success("保存完了！")
+                del st.session_state["preview"]
+                st.session_state.pop("draft_diff", None)
+
+        st.markdown("---")
+        st.write("#### 🗑️ データの初期化")
+        c_res1, c_res2 = st.columns(2)
+        with c_res1:
+            with st.expander("⚠️ 学生の「希望」を全てリセット"):
+                st.warning("来月の日程調整を始める前に押してください。")
+                if st.button("希望データを削除", type="primary"):
+                    db.reset_requests()
+                    st.success("リセットしました")
+                    st.rerun()
+        with c_res2:
+            with st.expander("⚠️ レッスン履歴を全てリセット"):
+                st.warning("半期が変わる時だけ使ってください。")
+                if st.button("履歴を削除", type="primary"):
+                    db.reset_history()
+                    st.success("リセットしました")
+                    st.rerun()
 
-    st.markdown("---")
-    st.write("#### 🗑️ データの初期化")
-    c_res1, c_res2 = st.columns(2)
-    with c_res1:
-        with st.expander("⚠️ 学生の「希望」を全てリセット"):
-            st.warning("来月の日程調整を始める前に押してください。")
-            if st.button("希望データを削除", type="primary"):
-                supabase.table("requests").delete().neq("id", 0).execute()
-                st.success("リセットしました")
-                st.rerun()
-    with c_res2:
-        with st.expander("⚠️ レッスン履歴を全てリセット"):
-            st.warning("半期が変わる時だけ使ってください。")
-            if st.button("履歴を削除", type="primary"):
-                supabase.table("history").delete().neq("id", 0).execute()
-                st.success("リセットしました")
-                st.rerun()
+        if profiler.enabled:
+            st.markdown("---")
+            with st.expander("⏱️ 計測 (再実行ごとの時間・往復回数)"):
+                slowest = profiler.slowest_reruns()
+                if slowest:
+                    st.write("##### 遅かった再実行")
+                    st.dataframe(pd.DataFrame([{
+                        "時刻": datetime.fromtimestamp(r["started"]).strftime("%m/%d %H:%M:%S"),
+                        "時間 (ms)": r["wall_ms"],
+                        "DB呼び出し": r["db_calls"],
+                        "往復": r["round_trips"],
+                        "行数": r["rows"],
+                        "最も遅い処理": max(r["calls"], key=lambda k: r["calls"][k]["ms"]) if r["calls"] else "",
+                    } for r in slowest]), hide_index=True, use_container_width=True)
+                stats = profiler.call_stats()
+                if stats:
+                    st.write("##### 呼び出しごと (p50 / p95)")
+                    st.dataframe(pd.DataFrame(stats).rename(columns={
+                        "name": "処理", "n": "回数", "p50_ms": "p50 (ms)", "p95_ms": "p95 (ms)", "rows_avg": "平均行数",
+                    }), hide_index=True, use_container_width=True)
+                else: st.info("まだ記録がありません")
+                if st.button("計測をクリア"):
+                    profiler.clear(); st.rerun()
 
 # ==========================================
 # タブ3: 集計
 # ==========================================
-with tab3:
-    st.header("全期間データ")
-    st.dataframe(load_history())
+if is_shown(tab3):
+    with tab3, profiler.section("tab3"):
+        st.header("全期間データ")
+        df_all = snap.history
+        warn_if_incomplete(df_all)
+        st.dataframe(df_all)
+
+profiler.finish_rerun()
@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# --- アプリの起動・再実行の計測 (streamlit の AppTest で app.py を動かす) ---
+# 使い方 (リポジトリ直下で):
+#   python -m bench.app_start --students 40 --slots 120 --reruns 10 --out app.json
+# 計測ごとに新しいプロセスを立ち上げ、学生タブの初回表示 (モジュールの import を含むコールドスタート) と、
+# 氏名を選んだ後の再実行の時間、その間に pandas が読み込まれたかを記録する。
+# データは SQLite に入れる (ネットワークの待ち時間は含まない)。
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child(args):
+    # 新しいプロセス側: ここより前に重いモジュールを import しない
+    t0 = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=60)
+    at.run()
+    cold = time.perf_counter() - t0
+    if at.exception: raise RuntimeError(at.exception)
+
+    box = at.selectbox(key="std_check") if args.closed else at.selectbox[0]
+    t0 = time.perf_counter()
+    box.set_value(args.student).run()
+    first = time.perf_counter() - t0
+    times = []
+    for _ in range(args.reruns):
+        t0 = time.perf_counter()
+        at.run()
+        times.append(time.perf_counter() - t0)
+    print(json.dumps({
+        "cold_start_s": cold,
+        "select_student_s": first,
+        "rerun_median_s": statistics.median(times),
+        "rerun_min_s": min(times),
+        "pandas_loaded": "pandas" in sys.modules,
+    }))
+
+
+def measure(args, path, closed):
+    env = dict(os.environ, LESSON_STORAGE="sqlite", LESSON_SQLITE_PATH=path)
+    cmd = [sys.executable, "-m", "bench.app_start", "--child", "--student", args.student, "--reruns", str(args.reruns)]
+    if closed: cmd.append("--closed")
+    out = subprocess.run(cmd, cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run(args):
+    from bench.run_bench import make_dataset, seed_sqlite, git_revision
+    tables, _ = make_dataset(args.students, args.slots, args.density, args.history, args.seed)
+    args.student = tables["students"][0]["name"]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "app.db")
+        backend = seed_sqlite(tables, path)
+        for closed in (False, True):
+            backend.update_settings({"is_open": not closed})
+            runs = [measure(args, path, closed) for _ in range(args.repeat)]
+            result = {"name": "student tab (closed)" if closed else "student tab (open)", "runs": args.repeat}
+            for field in ("cold_start_s", "select_student_s", "rerun_median_s", "rerun_min_s"):
+                result[field] = statistics.median(r[field] for r in runs)
+            result["pandas_loaded"] = any(r["pandas_loaded"] for r in runs)
+            results.append(result)
+            print(f"{result['name']:<22} cold {result['cold_start_s'] * 1000:8.1f} ms  "
+                  f"rerun {result['rerun_median_s'] * 1000:7.1f} ms  pandas={result['pandas_loaded']}", file=sys.stderr)
+    return {"meta": {"revision": git_revision(), "params": vars(args)}, "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="app.py の起動と学生タブの再実行の計測")
+    parser.add_argument("--students", type=int, default=40, help="学生数")
+    parser.add_argument("--slots", type=int, default=120, help="1学期あたりの枠数")
+    parser.add_argument("--density", type=float, default=0.15, help="各枠を希望する確率")
+    parser.add_argument("--history", type=int, default=10, help="1人あたりの過去のレッスン数")
+    parser.add_argument("--reruns", type=int, default=10, help="1プロセスあたりの再実行の回数")
+    parser.add_argument("--repeat", type=int, default=3, help="プロセスを立ち上げる回数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="結果の JSON を書き出すファイル (省略時は標準出力)")
+    # 内部用: 計測する側のプロセス
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--closed", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--student", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child: return child(args)
+
+    report = run(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f: f.write(text + "\n")
+    else: print(text)
+
+
+if __name__ == "__main__":
+    main()
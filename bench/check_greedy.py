@@ -0,0 +1,108 @@
+import argparse
+import random
+import sys
+from collections import Counter, defaultdict
+from datetime import date
+
+import pandas as pd
+
+from allocator import allocate_greedy
+from slot_utils import normalize_date_text, parse_slot, sort_slots
+from bench.run_bench import make_slots
+
+# --- 貪欲法の同値チェック ---
+# allocator.allocate_greedy が、app.py に直接書かれていた元の割り当て処理と
+# 同じ乱数列で同じ結果になるかを、乱数で作った入力で確かめる。
+# 使い方 (リポジトリ直下で):
+#   python -m bench.check_greedy --seeds 30
+# 食い違いがあれば内容を表示して終了コード 1 で終わる。
+
+
+def original_greedy(current_slots, req_map, df_hist, rng):
+    # 元の app.py の処理そのまま (random.random() だけ rng に置き換え)
+    slot_applicants = {s: [] for s in current_slots}
+    for name, wishes in req_map.items():
+        for w in wishes:
+            if w in current_slots: slot_applicants[w].append(name)
+
+    final_schedule = {}
+    current_batch_counts = defaultdict(int)
+    daily_counts = defaultdict(lambda: defaultdict(int))
+    daily_last_end = defaultdict(lambda: defaultdict(str))
+
+    for slot in sort_slots(current_slots):
+        cands = slot_applicants[slot]
+        if not cands: continue
+
+        info = parse_slot(slot)
+        semester = info.semester
+        date_part, s_time, e_time = info.date, info.start or "00:00", info.end or "00:00"
+
+        scored_cands = []
+        for student in cands:
+            if daily_counts[student][date_part] >= 2: continue
+            past_count = len(df_hist[(df_hist["受講者"] == student) & (df_hist["学期"] == semester)])
+            total_count = past_count + current_batch_counts[student]
+            penalty = 0
+            if daily_counts[student][date_part] == 1:
+                prev_end = daily_last_end[student][date_part]
+                if prev_end == s_time: penalty = -50
+                else: penalty = 999
+            scored_cands.append((total_count + penalty, rng.random(), student))
+
+        if scored_cands:
+            scored_cands.sort()
+            winner = scored_cands[0][2]
+            final_schedule[slot] = winner
+            current_batch_counts[winner] += 1
+            daily_counts[winner][date_part] += 1
+            daily_last_end[winner][date_part] = e_time
+    return final_schedule
+
+
+def make_case(rng, students, slots, density, history):
+    # 前期・後期の枠を作り、一部を間引いて離れ枠も混ぜる
+    year = date.today().year
+    raw = make_slots(date(year, 4, 7), slots // 2) + make_slots(date(year, 10, 1), slots - slots // 2)
+    current_slots = [normalize_date_text(s) for s in raw if rng.random() < 0.8]
+    names = [f"学生{i:03d}" for i in range(students)]
+    req_map = {}
+    for n in names:
+        wishes = [s for s in current_slots if rng.random() < density]
+        if wishes: req_map[n] = wishes
+    rows = [(n, rng.choice(["前期", "後期"])) for n in names for _ in range(rng.randint(0, history))]
+    df_hist = pd.DataFrame(rows, columns=["受講者", "学期"])
+    return current_slots, req_map, df_hist
+
+
+def check(seed, args):
+    current_slots, req_map, df_hist = make_case(random.Random(seed), args.students, args.slots, args.density, args.history)
+    past_counts = Counter(zip(df_hist["受講者"], df_hist["学期"]))
+    expected = original_greedy(current_slots, req_map, df_hist, random.Random(seed))
+    actual = allocate_greedy(current_slots, req_map, past_counts, random.Random(seed))
+    return [(s, expected.get(s), actual.get(s)) for s in sort_slots(set(expected) | set(actual))
+            if expected.get(s) != actual.get(s)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="allocate_greedy と元の割り当て処理の同値チェック")
+    parser.add_argument("--seeds", type=int, default=30, help="試す乱数シードの数")
+    parser.add_argument("--students", type=int, default=30, help="学生数")
+    parser.add_argument("--slots", type=int, default=80, help="枠数 (前期・後期の合計、間引く前)")
+    parser.add_argument("--density", type=float, default=0.2, help="各枠を希望する確率")
+    parser.add_argument("--history", type=int, default=6, help="1人あたりの過去のレッスン数の上限")
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for seed in range(args.seeds):
+        diff = check(seed, args)
+        if not diff: continue
+        failed += 1
+        print(f"seed={seed}: {len(diff)}枠が食い違い")
+        for slot, old, new in diff[:5]: print(f"  {slot}: 元={old} 新={new}")
+    print(f"{args.seeds - failed}/{args.seeds} シードで一致")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
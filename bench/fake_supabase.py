@@ -0,0 +1,296 @@
+import copy
+import threading
+import time
+from collections import Counter
+
+# --- Supabase クライアントのインメモリ代替 (ベンチマーク用) ---
+# アプリが使う範囲 (table().select/insert/upsert/delete/eq/neq/lt/in_/order/range/execute と rpc()) だけを再現する。
+# execute() 1回を1往復として数え、latency 秒だけ待つ。
+# 外部キーの連鎖削除などDB側の制約は再現しない。
+# 列名は sql/ のスキーマ (SCHEMAS) と照らし合わせ、無い列を使うと PostgREST と同じくエラーにする。
+
+
+class FakeAPIError(Exception):
+    # postgrest.exceptions.APIError と同じく code を持つ
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+def _history_counts(tables):
+    counts = Counter((r.get("student_name"), r.get("semester")) for r in tables.get("history", []))
+    return [{"student_name": s, "semester": sem, "lessons": n} for (s, sem), n in counts.items()]
+
+
+def _slot_demand(tables):
+    counts = Counter(r.get("date_text") for r in tables.get("request_slots", []))
+    return [{"date_text": s, "applicants": n} for s, n in counts.items()]
+
+
+# 読み取り専用ビュー: 名前 -> 元テーブルから行を作る関数
+VIEWS = {"history_counts": _history_counts, "slot_demand": _slot_demand}
+
+# テーブル・ビューの列 (sql/ のマイグレーション後)
+SCHEMAS = {
+    "app_settings": {"id", "is_open", "slots_version", "requests_version", "history_version", "students_version",
+                     "drafts_version"},
+    "slots": {"id", "date_text"},
+    "students": {"id", "name"},
+    "requests": {"id", "student_name", "wishes", "memo", "version"},
+    "request_slots": {"student_name", "date_text"},
+    "history": {"id", "date_text", "student_name", "semester"},
+    "drafts": {"id", "created_at", "schedule", "wishes"},
+    "documents": {"name", "body", "updated_at"},
+    "history_counts": {"student_name", "semester", "lessons"},
+    "slot_demand": {"date_text", "applicants"},
+}
+
+
+def _submit_requests(client, payload):
+    # sql/007_request_versions.sql の submit_requests と同じ動き
+    requests, request_slots = client.tables.setdefault("requests", []), client.tables.setdefault("request_slots", [])
+    slots = {r.get("date_text") for r in client.tables.get("slots", [])}
+    students = {r.get("name") for r in client.tables.get("students", [])}
+    results = []
+    for item in payload:
+        name = item["student_name"]
+        stored = next((r for r in requests if r.get("student_name") == name), None)
+        current = stored.get("version", 0) if stored else 0
+        ok = current == item.get("version", 0)
+        if ok:
+            if stored is None:
+                stored = {"id": client.next_id(), "student_name": name}
+                requests.append(stored)
+            stored.update(memo=item.get("memo"), version=current + 1)
+            request_slots[:] = [r for r in request_slots if r.get("student_name") != name]
+            for s in dict.fromkeys(item.get("wishes", [])):
+                if s in slots and name in students: request_slots.append({"student_name": name, "date_text": s})
+        results.append({
+            "student_name": name,
+            "memo": stored.get("memo") if stored else None,
+            "wishes": [r["date_text"] for r in request_slots if r.get("student_name") == name],
+            "version": stored.get("version", 0) if stored else 0,
+            "ok": ok,
+        })
+    return results
+
+
+# ストアド関数: 名前 -> (client, params の値) から行を返す関数
+RPCS = {"submit_requests": _submit_requests}
+
+
+class FakeRPC:
+    def __init__(self, client, name, params):
+        self.client, self.name, self.params = client, name, params
+
+    def execute(self):
+        client = self.client
+        client.wait()
+        with client.lock:
+            client.calls["rpc:" + self.name] += 1
+            if self.name not in RPCS: raise FakeAPIError(f"function {self.name} does not exist", "PGRST202")
+            data = RPCS[self.name](client, *copy.deepcopy(list(self.params.values())))
+            client.rows["rpc:" + self.name] += len(data)
+            return FakeResponse(data)
+
+
+class FakeQuery:
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.op = "select"
+        self.columns = "*"
+        self.count = None
+        self.payload = None
+        self.on_conflict = "id"
+        self.ignore_duplicates = False
+        self.filters = []
+        self.used = set()       # 条件・並び順・選択で使った列 (SCHEMAS と照らし合わせる)
+        self.order_by = []      # [(列, 降順か)] (order() を重ねると後の列で同順位を並べる)
+        self.row_range = None
+
+    # --- 操作 ---
+
+    def select(self, columns="*", count=None):
+        self.op, self.columns, self.count = "select", columns, count
+        if columns.strip() != "*": self.used.update(c.strip() for c in columns.split(","))
+        return self
+
+    def insert(self, data):
+        self.op, self.payload = "insert", data
+        return self
+
+    def upsert(self, data, on_conflict="id", ignore_duplicates=False):
+        self.op, self.payload = "upsert", data
+        self.on_conflict, self.ignore_duplicates = on_conflict or "id", ignore_duplicates
+        self.used.update(k.strip() for k in self.on_conflict.split(","))
+        return self
+
+    def update(self, data):
+        self.op, self.payload = "update", data
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    # --- 絞り込み ---
+
+    def eq(self, column, value):
+        self.used.add(column)
+        self.filters.append(lambda r: r.get(column) == value)
+        return self
+
+    def neq(self, column, value):
+        self.used.add(column)
+        self.filters.append(lambda r: r.get(column) != value)
+        return self
+
+    def lt(self, column, value):
+        self.used.add(column)
+        self.filters.append(lambda r: r.get(column) is not None and r.get(column) < value)
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self.used.add(column)
+        self.filters.append(lambda r: r.get(column) in values)
+        return self
+
+    def order(self, column, desc=False):
+        self.order_by.append((column, desc))
+        self.used.add(column)
+        return self
+
+    def range(self, start, end):
+        self.row_range = (start, end)
+        return self
+
+    def limit(self, n):
+        self.row_range = (0, n - 1)
+        return self
+
+    # --- 実行 ---
+
+    def _match(self, row):
+        return all(f(row) for f in self.filters)
+
+    def _project(self, row):
+        if self.columns.strip() == "*": return dict(row)
+        return {c.strip(): row.get(c.strip()) for c in self.columns.split(",")}
+
+    def _rows(self, data):
+        return [dict(r) for r in (data if isinstance(data, list) else [data])]
+
+    def _check_columns(self):
+        columns = SCHEMAS.get(self.table)
+        if columns is None: return
+        used = set(self.used)
+        if self.payload is not None:
+            for row in self._rows(self.payload): used.update(row)
+        unknown = sorted(used - columns)
+        if unknown: raise FakeAPIError(f'column {self.table}.{unknown[0]} does not exist', "42703")
+
+    def execute(self):
+        client = self.client
+        client.wait()
+        with client.lock:
+            client.calls[self.table] += 1
+            if self.table in VIEWS:
+                if self.op != "select": raise FakeAPIError(f"{self.table} is a view", "42809")
+                table = VIEWS[self.table](client.tables)
+            elif self.table in client.tables:
+                table = client.tables[self.table]
+            else:
+                raise FakeAPIError(f'relation "{self.table}" does not exist', "42P01")
+            self._check_columns()
+            result = getattr(self, "_" + self.op)(table)
+            client.rows[self.table] += len(result.data)
+            return result
+
+    def _select(self, table):
+        rows = [r for r in table if self._match(r)]
+        # 後の列から順に安定ソートすると、前の列が優先になる
+        for column, desc in reversed(self.order_by):
+            rows.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=desc)
+        total = len(rows) if self.count else None
+        start, end = self.row_range or (0, len(rows) - 1)
+        # PostgREST と同じく1回の応答は max_rows 行まで
+        end = min(end, start + self.client.max_rows - 1)
+        return FakeResponse(copy.deepcopy([self._project(r) for r in rows[start:end + 1]]), total)
+
+    def _insert(self, table):
+        inserted = []
+        for row in self._rows(self.payload):
+            row.setdefault("id", self.client.next_id())
+            table.append(row)
+            inserted.append(row)
+        return FakeResponse(copy.deepcopy(inserted))
+
+    def _upsert(self, table):
+        keys = [k.strip() for k in self.on_conflict.split(",")]
+        written = []
+        for row in self._rows(self.payload):
+            existing = next((r for r in table if all(r.get(k) == row.get(k) for k in keys)), None)
+            if existing is not None:
+                if self.ignore_duplicates: continue
+                # requests の更新トリガー (版数を指定しない更新でも1つ進める)
+                if self.table == "requests" and "version" not in row: row["version"] = existing.get("version", 0) + 1
+                existing.update(row)
+                written.append(existing)
+            else:
+                row.setdefault("id", self.client.next_id())
+                table.append(row)
+                written.append(row)
+        return FakeResponse(copy.deepcopy(written))
+
+    def _update(self, table):
+        updated = []
+        for row in table:
+            if self._match(row):
+                row.update(self.payload)
+                updated.append(row)
+        return FakeResponse(copy.deepcopy(updated))
+
+    def _delete(self, table):
+        deleted = [r for r in table if self._match(r)]
+        table[:] = [r for r in table if not self._match(r)]
+        return FakeResponse(copy.deepcopy(deleted))
+
+
+class FakeSupabase:
+    def __init__(self, tables=None, latency=0.0, max_rows=1000):
+        self.tables = {name: [dict(r) for r in rows] for name, rows in (tables or {}).items()}
+        self.latency = latency      # 1往復あたりの待ち時間 (秒)
+        self.max_rows = max_rows    # 1回の select で返す最大行数
+        self.lock = threading.Lock()
+        self.calls = Counter()      # テーブル -> execute() 回数
+        self.rows = Counter()       # テーブル -> 返した行数
+        self._id = max((r.get("id", 0) for rows in self.tables.values() for r in rows), default=0)
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def rpc(self, name, params=None):
+        return FakeRPC(self, name, params or {})
+
+    def next_id(self):
+        self._id += 1
+        return self._id
+
+    def wait(self):
+        if self.latency: time.sleep(self.latency)
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.rows.clear()
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
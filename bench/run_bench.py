@@ -0,0 +1,279 @@
+import argparse
+import json
+import platform
+import random
+import statistics
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from allocator import allocate_greedy, allocate_multi_seed, allocate_optimal, past_counts_from_aggregate, schedule_metrics
+from db import LessonDB, version_column, CACHED_TABLES
+from storage import SQLiteBackend, SupabaseBackend
+from slot_utils import group_continuous_slots, normalize_date_text, parse_slot, sort_slots
+from bench.fake_supabase import FakeSupabase
+
+# --- ベンチマーク (Supabase なしで実行できる) ---
+# 使い方 (リポジトリ直下で):
+#   python -m bench.run_bench --students 40 --slots 120 --latency 0.03 --out bench.json
+# 結果は JSON で出力し、版ごとの比較に使う。
+
+LESSON_MINUTES = 50
+SLOTS_PER_DAY = 6
+
+
+def make_slots(first_day, count):
+    # first_day から平日に 10:00 開始の50分枠を1日 SLOTS_PER_DAY 個ずつ作る
+    raw, day = [], first_day
+    while len(raw) < count:
+        if day.weekday() < 5:
+            for k in range(min(SLOTS_PER_DAY, count - len(raw))):
+                minutes = 10 * 60 + LESSON_MINUTES * k
+                raw.append(f"{day.month}/{day.day} {minutes // 60}:{minutes % 60:02d}")
+        day += timedelta(days=1)
+    return raw
+
+
+def make_dataset(students=40, slots=120, density=0.15, history=10, seed=0):
+    # students 人, 1学期 slots 枠, 各枠を density の確率で希望, 1人あたり過去 history 回
+    rng = random.Random(seed)
+    year = date.today().year
+    names = [f"学生{i:03d}" for i in range(students)]
+    raw_autumn = make_slots(date(year, 9, 8), slots)
+    spring = [normalize_date_text(s) for s in make_slots(date(year, 4, 7), slots)]
+    autumn = [normalize_date_text(s) for s in raw_autumn]
+
+    requests, request_slots = [], []
+    for name in names:
+        requests.append({"student_name": name, "memo": ""})
+        request_slots.extend({"student_name": name, "date_text": s} for s in autumn if rng.random() < density)
+    hist_rows = []
+    for name in names:
+        for s in rng.sample(spring, min(history, len(spring))):
+            hist_rows.append({"date_text": s, "student_name": name, "semester": parse_slot(s).semester})
+
+    settings = {"id": 1, "is_open": True, **{version_column(t): 0 for t in CACHED_TABLES}}
+    tables = {
+        "app_settings": [settings],
+        "slots": [{"date_text": s} for s in autumn],
+        "students": [{"name": n} for n in names],
+        "requests": requests,
+        "request_slots": request_slots,
+        "history": hist_rows,
+        "drafts": [],
+        "documents": [],
+    }
+    # id を振る
+    next_id = 1
+    for table, rows in tables.items():
+        if table == "request_slots": continue
+        for r in rows:
+            if "id" not in r:
+                r["id"] = next_id
+                next_id += 1
+    return tables, raw_autumn
+
+
+def seed_sqlite(tables, path):
+    backend = SQLiteBackend(path)
+    backend.insert_keys("slots", [r["date_text"] for r in tables["slots"]])
+    backend.insert_keys("students", [r["name"] for r in tables["students"]])
+    for r in tables["requests"]: backend.upsert_request(r)
+    wishes = defaultdict(list)
+    for r in tables["request_slots"]: wishes[r["student_name"]].append(r["date_text"])
+    for name, slots in wishes.items(): backend.replace_student_wishes(name, slots)
+    backend.insert_history(tables["history"])
+    return backend
+
+
+def simulate_rerun(db, student_name):
+    # app.py で学生タブを開いているときの1回の再実行と同じ読み取り
+    # (開いているタブが使う一覧だけを snapshot() で並行して先読みする)
+    db.refresh()
+    if not db.get_is_open():
+        db.load_closed_view()["lessons"].get(student_name, [])
+        return
+    snap = db.snapshot(("slots", "students", "request_rows"))
+    if snap.slots:
+        snap.request_rows.get(student_name, {})
+        db.load_student_lessons(student_name)
+        db.load_student_wishes(student_name)
+
+
+def simulate_rerun_sequential(db, student_name):
+    # 先読み・タブ遅延描画なしの app.py: タブごとに1件ずつ読む
+    db.refresh()
+    # タブ1
+    if db.get_is_open():
+        raw_slots = db.load_slots()
+        db.load_students()
+        if raw_slots:
+            current_slots = sort_slots(raw_slots)
+            db.load_requests()
+            db.load_student_lessons(student_name)
+            db.load_student_wishes(student_name)
+            slots_by_date = defaultdict(list)
+            for slot in current_slots: slots_by_date[parse_slot(slot).date].append(slot)
+    else:
+        db.load_slots()
+        db.load_students()
+        db.load_student_lessons(student_name)
+    # タブ2
+    db.get_is_open()
+    db.load_history_counts()
+    current_slots = sort_slots(db.load_slots())
+    group_continuous_slots(current_slots)
+    db.load_slot_demand()
+    sort_slots(db.load_slots())
+    db.load_students()
+    # タブ3
+    db.load_history()
+
+
+def submit_burst(db, req_map, queued):
+    # 全員がほぼ同時に「希望を送信する」を押す (学生1人 = 1スレッド)
+    versions = {name: row["version"] for name, row in db.load_request_rows().items()}
+    def one(name):
+        if queued: return db.submit_request(name, req_map.get(name, []), "", versions.get(name, 0))["ok"]
+        db.save_requests_row(name, req_map.get(name, []), "")
+        return True
+    names = list(req_map)
+    with ThreadPoolExecutor(max_workers=len(names) or 1) as pool:
+        return sum(pool.map(one, names))
+
+
+def timeit(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup: setup()
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {"runs": repeat, "min_s": min(times), "median_s": statistics.median(times), "max_s": max(times)}
+
+
+def run(args):
+    tables, raw_inputs = make_dataset(args.students, args.slots, args.density, args.history, args.seed)
+    slots = [r["date_text"] for r in tables["slots"]]
+    shuffled = slots[:]
+    random.Random(args.seed).shuffle(shuffled)
+    req_map = defaultdict(list)
+    for r in tables["request_slots"]: req_map[r["student_name"]].append(r["date_text"])
+    req_map = dict(req_map)
+    client = FakeSupabase(tables)
+    past_counts = past_counts_from_aggregate(LessonDB(SupabaseBackend(client)).load_history_counts())
+    results = []
+
+    def record(name, stats, **extra):
+        results.append({"name": name, **stats, **extra})
+        print(f"{name:<28} median {stats['median_s'] * 1000:9.2f} ms", file=sys.stderr)
+
+    record("sort_slots (cold)", timeit(lambda: sort_slots(shuffled), args.repeat, parse_slot.cache_clear))
+    record("sort_slots (warm)", timeit(lambda: sort_slots(shuffled), args.repeat))
+    ordered = sort_slots(shuffled)
+    record("group_continuous_slots", timeit(lambda: group_continuous_slots(ordered), args.repeat))
+    record("normalize_date_text", timeit(lambda: [normalize_date_text(s) for s in raw_inputs], args.repeat))
+    record("allocate_greedy", timeit(lambda: allocate_greedy(slots, req_map, past_counts, random.Random(0)), args.repeat),
+           metrics=schedule_metrics(slots, req_map, past_counts, allocate_greedy(slots, req_map, past_counts, random.Random(0))))
+    if args.optimal_budget > 0:
+        best = {}
+        def optimal():
+            best["schedule"] = allocate_optimal(slots, req_map, past_counts, time_budget=args.optimal_budget)
+        record("allocate_optimal", timeit(optimal, 1),
+               time_budget_s=args.optimal_budget, metrics=schedule_metrics(slots, req_map, past_counts, best["schedule"]))
+        def multi_seed():
+            best["schedule"], best["seed"], best["tried"] = allocate_multi_seed(
+                slots, req_map, past_counts, time_budget=args.optimal_budget)
+        record("allocate_multi_seed", timeit(multi_seed, 1), time_budget_s=args.optimal_budget,
+               workers=os.cpu_count(), seed=best["seed"], seeds_tried=best["tried"],
+               metrics=schedule_metrics(slots, req_map, past_counts, best["schedule"]))
+
+    # 再実行: 初回 (キャッシュなし) と2回目以降 (版数確認のみ)
+    student = tables["students"][0]["name"]
+    client = FakeSupabase(tables, latency=args.latency)
+    backend = SupabaseBackend(client)
+    state = {}
+
+    def cold_setup():
+        state["db"] = LessonDB(backend)
+        client.reset_counters()
+
+    cold = timeit(lambda: simulate_rerun(state["db"], student), args.repeat, cold_setup)
+    record("rerun (cold cache)", cold, round_trips=client.round_trips, rows=sum(client.rows.values()),
+           calls=dict(client.calls))
+    cold_seq = timeit(lambda: simulate_rerun_sequential(state["db"], student), args.repeat, cold_setup)
+    record("rerun sequential (cold cache)", cold_seq, round_trips=client.round_trips, rows=sum(client.rows.values()),
+           calls=dict(client.calls))
+    db = LessonDB(backend)
+    simulate_rerun(db, student)
+    warm = timeit(lambda: simulate_rerun(db, student), args.repeat, client.reset_counters)
+    record("rerun (warm cache)", warm, round_trips=client.round_trips, rows=sum(client.rows.values()),
+           calls=dict(client.calls))
+
+    # 締め切り前の一斉送信: 1人ずつ書く場合と送信キューでまとめる場合
+    shifted = {name: slots_[1:] for name, slots_ in req_map.items()}
+    for label, queued in [("submit burst (per student)", False), ("submit burst (queued)", True)]:
+        client = FakeSupabase(tables, latency=args.latency)
+        db = LessonDB(SupabaseBackend(client))
+        db.load_request_rows()
+        client.reset_counters()
+        t0 = time.perf_counter()
+        saved = submit_burst(db, shifted, queued)
+        elapsed = time.perf_counter() - t0
+        record(label, {"runs": 1, "min_s": elapsed, "median_s": elapsed, "max_s": elapsed},
+               students=len(shifted), saved=saved, round_trips=client.round_trips, calls=dict(client.calls))
+
+    # 同じデータを SQLite に入れた場合
+    with tempfile.TemporaryDirectory() as tmp:
+        backend = seed_sqlite(tables, os.path.join(tmp, "bench.db"))
+        record("rerun sqlite (cold cache)",
+               timeit(lambda: simulate_rerun(state["db"], student), args.repeat,
+                      lambda: state.update(db=LessonDB(backend))))
+        db = LessonDB(backend)
+        simulate_rerun(db, student)
+        record("rerun sqlite (warm cache)", timeit(lambda: simulate_rerun(db, student), args.repeat))
+
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "params": vars(args),
+        },
+        "results": results,
+    }
+
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except Exception: return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="レッスン調整アプリのベンチマーク (インメモリDB)")
+    parser.add_argument("--students", type=int, default=40, help="学生数")
+    parser.add_argument("--slots", type=int, default=120, help="1学期あたりの枠数")
+    parser.add_argument("--density", type=float, default=0.15, help="各枠を希望する確率")
+    parser.add_argument("--history", type=int, default=10, help="1人あたりの過去のレッスン数")
+    parser.add_argument("--latency", type=float, default=0.0, help="1往復あたりの待ち時間 (秒)")
+    parser.add_argument("--optimal-budget", type=float, default=1.0, help="最適化モードの時間上限 (0で省略)")
+    parser.add_argument("--repeat", type=int, default=5, help="各計測の繰り返し回数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="結果の JSON を書き出すファイル (省略時は標準出力)")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f: f.write(text + "\n")
+    else: print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,531 @@
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import NamedTuple
+from slot_utils import normalize_date_text, slot_sort_key
+from storage import is_missing_function, is_missing_relation
+
+# --- DB操作 ---
+# 実際の読み書きは storage.py の保存先 (Supabase / SQLite) に任せる。
+# load_* の結果はテーブルごとにプロセス内でキャッシュし、
+# app_settings (id=1) の "<table>_version" が変わったときだけ取り直す。
+# 1回の再実行では refresh() で設定行を1回読むだけになる。
+# pandas は管理画面の表 (集計・プレビュー・履歴) を作るときだけ読み込む。
+# 学生画面は dict / list を返す load_request_rows() などだけで描ける。
+
+CACHED_TABLES = ("slots", "requests", "history", "students", "drafts")
+
+# 履歴の列名 (DB -> 画面)
+HISTORY_COLUMNS = {"date_text": "日時", "student_name": "受講者", "semester": "学期"}
+HISTORY_CATEGORIES = ("受講者", "学期")
+
+# 募集停止中の学生画面用の文書
+CLOSED_VIEW = "closed_view"
+CLOSED_VIEW_TABLES = ("history", "students")
+
+PREFETCH_WORKERS = 8   # 先読みで同時に投げる読み込みの上限 (全セッション共通)
+
+# 希望の送信キュー
+COALESCE_WINDOW = 0.05 # 最初の送信から一括書き込みまで待つ秒数 (この間の送信をまとめる)
+COALESCE_MAX = 200     # 1回の一括書き込みの最大人数
+SUBMIT_TIMEOUT = 30    # 送信した画面が結果を待つ最大秒数
+
+logger = logging.getLogger(__name__)
+
+
+# --- 履歴の集計 (受講者, 学期, 回数) ---
+
+def aggregate_history_counts(df_hist):
+    # ローカル版: history_counts ビューと同じ形を pandas で作る
+    import pandas as pd
+    if df_hist.empty: return pd.DataFrame({"受講者": [], "学期": [], "回数": []})
+    counts = df_hist.groupby(["受講者", "学期"], observed=True).size().reset_index(name="回数")
+    return counts[counts["回数"] > 0].reset_index(drop=True)
+
+
+def counts_crosstab(df_counts):
+    # pd.crosstab(受講者, 学期, margins=True) と同じ表を集計結果から作る
+    return df_counts.pivot_table(index="受講者", columns="学期", values="回数", aggfunc="sum",
+                                 fill_value=0, margins=True, margins_name="合計", observed=True)
+
+
+def version_column(table):
+    return f"{table}_version"
+
+
+class Snapshot(NamedTuple):
+    # 1回の再実行で各タブが使うデータ (snapshot() でまとめて読む)
+    # 読まなかった項目は None (表示中のタブが使うものだけを読む)
+    is_open: bool
+    slots: list = None            # 年度順
+    students: list = None
+    request_rows: dict = None     # 氏名 -> {"memo", "version"}
+    slot_demand: dict = None      # 枠 -> 応募数
+    history_counts: object = None # DataFrame (受講者, 学期, 回数)
+    history: object = None        # DataFrame (日時, 受講者, 学期)
+    draft: dict = None            # 最新のシフトの下書き (無ければ None)
+
+
+class SubmissionQueue:
+    # 締め切り前に集中する送信をまとめて書く。
+    # 同じ画面 (セッション, 学生, 元の版数) からの連続送信は最後の内容だけを書き、
+    # COALESCE_WINDOW 秒の間に届いた全員分を write(rows) 1回で書く。
+    def __init__(self, write, window=COALESCE_WINDOW, max_batch=COALESCE_MAX):
+        self.write = write            # rows -> rows と同じ順の結果
+        self.window = window
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._pending = {}            # (セッション, 学生, 元の版数) -> (row, [Future])
+        self._thread = None
+
+    def submit(self, row, session=None):
+        # session: 送信した画面のセッション。別の画面 (別タブなど) の送信はまとめず、
+        # 版数の確認で後から届いた方を衝突にする。None なら他の送信とまとめない
+        future = Future()
+        key = (session if session is not None else future, row["student_name"], row["version"])
+        with self._cond:
+            _, futures = self._pending.get(key, (None, []))
+            self._pending[key] = (row, futures + [future])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lesson-submit", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending: self._cond.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch:
+                left = deadline - time.monotonic()
+                if left <= 0: break
+                self._cond.wait(left)
+            keys = list(self._pending)[:self.max_batch]
+            return [self._pending.pop(k) for k in keys]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self.write([row for row, _ in batch])
+            except Exception as e:
+                for _, futures in batch:
+                    for f in futures: f.set_exception(e)
+                continue
+            for i, (_, futures) in enumerate(batch):
+                # 結果の行が足りない (保存先の不具合) ときも待たせたままにしない
+                for f in futures:
+                    if i < len(results): f.set_result(results[i])
+                    else: f.set_exception(RuntimeError(f"submit_requests: {len(batch)}件中 {len(results)}件の結果しか返りませんでした"))
+
+
+class LessonDB:
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._cache = {}        # (table, 取得方法) -> (version, data)
+        self._settings = None   # app_settings の最新の行 (取得失敗時は None)
+        self._pool = None       # 先読み用のスレッドプール (最初の snapshot() で作る)
+        self._queue = None      # 希望の送信キュー (最初の submit_request() で作る)
+
+    # --- 版数 (バージョンスタンプ) ---
+
+    def refresh(self):
+        # 再実行の先頭で1回だけ呼ぶ
+        try: settings = self.backend.get_settings()
+        except: settings = None
+        with self._lock:
+            self._settings = settings
+
+    def _version(self, table):
+        if self._settings is None: self.refresh()
+        settings = self._settings or {}
+        return settings.get(version_column(table))
+
+    def _cached(self, table, loader, variant=None):
+        # table: テーブル名、または複数のテーブル (どれかが変わったら読み直す) のタプル
+        tables = table if isinstance(table, tuple) else (table,)
+        version = tuple(self._version(t) for t in tables)
+        # 版数の列がまだ無いDBではキャッシュせず毎回読む
+        if None in version: return loader()
+        key = (table, variant)
+        with self._lock:
+            hit = self._cache.get(key)
+        if hit and hit[0] == version: return hit[1]
+        data = loader()
+        with self._lock:
+            self._cache[key] = (version, data)
+        return data
+
+    def bump(self, *tables):
+        # 書き込み後に呼ぶ。他プロセスも次の refresh() で変更に気づく
+        stamp = time.time_ns()
+        values = {version_column(t): stamp for t in tables}
+        with self._lock:
+            for key in [k for k in self._cache if set(k[0] if isinstance(k[0], tuple) else (k[0],)) & set(tables)]:
+                del self._cache[key]
+            if self._settings: self._settings.update(values)
+        try: self.backend.update_settings(values)
+        except: pass
+
+    # --- 差分同期 ---
+    # 一意キー列 (slots.date_text / students.name) の値の集合として比べ、
+    # 必要な行だけをまとめて削除・追加する。
+
+    def _insert_missing(self, table, values, stored=None):
+        if stored is None: stored = set(self.backend.list_keys(table))
+        to_insert = [v for v in values if v not in stored]
+        if to_insert: self.backend.insert_keys(table, to_insert)
+        return len(to_insert)
+
+    def _delete_values(self, table, values):
+        values = list(dict.fromkeys(values))
+        if not values: return 0
+        return self.backend.delete_keys(table, values)
+
+    def _sync_column(self, table, values):
+        # 戻り値: (追加した行数, 削除した行数)
+        stored = set(self.backend.list_keys(table))
+        desired = set(values)
+        removed = self._delete_values(table, [v for v in stored if v not in desired])
+        added = self._insert_missing(table, values, stored)
+        return added, removed
+
+    # --- 枠 ---
+
+    def _fetch_slots(self):
+        return self.backend.list_keys("slots")
+
+    def load_slots(self):
+        return list(self._cached("slots", self._fetch_slots))
+
+    def save_slots(self, slot_list):
+        # 一覧全体で置き換える (差分の行だけ削除・追加する)
+        normalized_list = [normalize_date_text(s) for s in slot_list]
+        unique_list = sorted(set(normalized_list), key=slot_sort_key)
+        added, removed = self._sync_column("slots", unique_list)
+        # 削除した枠の希望は request_slots から連鎖削除される
+        if removed: self.bump("slots", "requests")
+        elif added: self.bump("slots")
+        return added, removed
+
+    def add_slots(self, slot_list, normalize=True):
+        # 既存の枠はそのままで、新しい枠だけ追加する
+        # normalize=False: 生成済みの正しい表記 (年をまたぐ曜日も含む) をそのまま使う
+        normalized_list = [normalize_date_text(s) for s in slot_list] if normalize else list(slot_list)
+        unique_list = sorted(set(normalized_list), key=slot_sort_key)
+        added = self._insert_missing("slots", unique_list)
+        if added: self.bump("slots")
+        return added
+
+    def reset_slots(self):
+        # 全削除 (差分を取らずにまとめて消す。希望は request_slots から連鎖削除される)
+        self.backend.clear("slots")
+        self.bump("slots", "requests")
+
+    def remove_slots(self, slot_list):
+        removed = self._delete_values("slots", slot_list)
+        if removed: self.bump("slots", "requests")
+        return removed
+
+    # --- 希望 ---
+
+    def _fetch_request_rows(self):
+        # 希望枠は request_slots にあるので、旧 wishes 列は使わない
+        # memo / version が無い古いDBでは空文字 / 0 とする (version は送信時の楽観的排他に使う)
+        return {
+            row["student_name"]: {"memo": row.get("memo") or "", "version": row.get("version") or 0}
+            for row in self.backend.list_requests()
+        }
+
+    def load_request_rows(self):
+        # 氏名 -> {"memo", "version"} (pandas を使わない)
+        return {name: dict(row) for name, row in self._cached("requests", self._fetch_request_rows).items()}
+
+    def load_requests(self):
+        # 氏名とメモの表 (管理画面用)
+        import pandas as pd
+        rows = self.load_request_rows()
+        return pd.DataFrame({
+            "氏名": list(rows),
+            "メモ": [r["memo"] for r in rows.values()],
+            "version": [r["version"] for r in rows.values()],
+        })
+
+    def _fetch_wishes(self):
+        wishes = {}
+        for row in self.backend.list_request_slots():
+            wishes.setdefault(row["student_name"], []).append(row["date_text"])
+        return {name: sorted(slots, key=slot_sort_key) for name, slots in wishes.items()}
+
+    def load_wishes(self):
+        # 学生 -> 希望枠 (年度順)。シフト作成用
+        return {name: list(slots) for name, slots in self._cached("requests", self._fetch_wishes, variant="wishes").items()}
+
+    def load_student_wishes(self, name):
+        fetch = lambda: sorted(self.backend.student_wishes(name), key=slot_sort_key)
+        return list(self._cached("requests", fetch, variant=("wishes", name)))
+
+    def load_slot_demand(self):
+        # 枠 -> 応募数
+        fetch = lambda: {row["date_text"]: int(row["applicants"]) for row in self.backend.slot_demand()}
+        return dict(self._cached("requests", fetch, variant="demand"))
+
+    def save_requests_row(self, name, wishes, memo_str):
+        # wishes: 枠のリスト
+        self.backend.save_request(name, memo_str, list(dict.fromkeys(wishes)))
+        self.bump("requests")
+
+    def _write_submissions(self, rows):
+        try:
+            results = self.backend.submit_requests(rows)
+        except Exception as e:
+            # 一括書き込みの関数がまだ無いDBでだけ1人ずつ書く (通信エラーなどは送信した画面へ返す)
+            if not is_missing_function(e): raise
+            logger.info("submit_requests が使えないため1人ずつ保存します: %s", e)
+            results = self._write_submissions_each(rows)
+        if any(r["ok"] for r in results): self.bump("requests")
+        return results
+
+    def _write_submissions_each(self, rows):
+        # 1人ずつ版数を確かめてから書き、書いた後の内容を読み直して返す
+        # (確認と書き込みの間は排他にならないので、submit_requests 関数を入れるまでのつなぎ)
+        stored = {r["student_name"]: r for r in self.backend.list_requests()}
+        written = set()
+        ok = []
+        for row in rows:
+            name = row["student_name"]
+            # 同じ学生の2件目以降は、1件目で版数が進んでいるので衝突
+            ok.append(name not in written and (stored.get(name, {}).get("version") or 0) == row["version"])
+            if ok[-1]:
+                self.backend.save_request(name, row["memo"], row["wishes"])
+                written.add(name)
+        if written: stored = {r["student_name"]: r for r in self.backend.list_requests()}
+        results = []
+        for row, row_ok in zip(rows, ok):
+            saved = stored.get(row["student_name"], {})
+            results.append({
+                "student_name": row["student_name"],
+                "memo": saved.get("memo"),
+                "wishes": self.backend.student_wishes(row["student_name"]),
+                "version": saved.get("version") or 0,
+                "ok": row_ok,
+            })
+        return results
+
+    def submit_request(self, name, wishes, memo_str, version, session=None, timeout=SUBMIT_TIMEOUT):
+        # 送信キュー経由で保存する。version: 画面を開いたときの requests.version
+        # (DB側がそれより新しければ書かない)。session: 送信した画面のセッションを表す値。
+        # 戻り値: {student_name, memo, wishes, version, ok}。ok なら保存後、衝突なら DB 上の最新の内容
+        with self._lock:
+            if self._queue is None: self._queue = SubmissionQueue(self._write_submissions)
+            queue = self._queue
+        row = {"student_name": name, "memo": memo_str, "wishes": list(dict.fromkeys(wishes)), "version": int(version)}
+        result = queue.submit(row, session).result(timeout)
+        if not result["ok"] and set(result["wishes"]) == set(row["wishes"]) and (result["memo"] or "") == (memo_str or ""):
+            # 同じ内容が別の送信で先に保存されていた (二重送信など) なら保存済みとして扱う
+            result = {**result, "ok": True}
+        return result
+
+    def reset_requests(self):
+        self.backend.clear("request_slots")
+        self.backend.clear("requests")
+        self.bump("requests")
+
+    # --- 履歴 ---
+
+    def _fetch_history_values(self, columns):
+        # ページごとに列ごとのリストへ流し込む (行の dict を溜め込まない)
+        values = {c: [] for c in columns}
+        expected, pages = self.backend.history_pages(columns)
+        for page in pages:
+            for c in columns:
+                values[c].extend(item.get(c) for item in page)
+        count = len(values[columns[0]]) if columns else 0
+        if expected is not None and count < expected:
+            logger.warning("history: %d / %d 行しか取得できませんでした", count, expected)
+        return values, (expected if expected is not None else count)
+
+    def _history_columns(self, columns):
+        # 履歴の指定列をリストで (pandas を使わない)
+        columns = tuple(columns)
+        values, _ = self._cached("history", lambda: self._fetch_history_values(columns), variant=("values", columns))
+        return [list(values[c]) for c in columns]
+
+    def _fetch_history(self, columns):
+        import pandas as pd
+        values, expected = self._cached("history", lambda: self._fetch_history_values(columns), variant=("values", columns))
+        df = pd.DataFrame({HISTORY_COLUMNS[c]: values[c] for c in columns})
+        for col in HISTORY_CATEGORIES:
+            if col in df.columns: df[col] = df[col].astype("category")
+        df.attrs["expected_rows"] = expected
+        return df
+
+    def load_history(self, columns=tuple(HISTORY_COLUMNS)):
+        # columns: 必要な DB 列だけを指定する (例: ("student_name", "semester"))
+        columns = tuple(columns)
+        return self._cached("history", lambda: self._fetch_history(columns), variant=columns).copy()
+
+    def _fetch_student_lessons(self, name):
+        return sorted(self.backend.student_lessons(name), key=slot_sort_key)
+
+    def load_student_lessons(self, name):
+        # 1人分の確定レッスン (日時のみ、年度順)。絞り込みは DB 側で行う
+        return list(self._cached("history", lambda: self._fetch_student_lessons(name), variant=("student", name)))
+
+    def _fetch_history_counts(self):
+        import pandas as pd
+        try:
+            rows = self.backend.history_counts()
+        except Exception as e:
+            # ビューがまだ無いDBでだけ全件を読んでローカルで集計する (通信エラーなどはそのまま)
+            if not is_missing_relation(e): raise
+            logger.info("history_counts が使えないためローカルで集計します: %s", e)
+            return aggregate_history_counts(self._fetch_history(("student_name", "semester")))
+        return pd.DataFrame({
+            "受講者": [r["student_name"] for r in rows],
+            "学期": [r["semester"] for r in rows],
+            "回数": [int(r["lessons"]) for r in rows],
+        })
+
+    def load_history_counts(self):
+        # DB側で集計した (受講者, 学期, 回数) の小さな表
+        return self._cached("history", self._fetch_history_counts, variant="counts").copy()
+
+    def save_history_new(self, df_new):
+        if df_new.empty: return
+        data = []
+        for _, row in df_new.iterrows():
+            data.append({
+                "date_text": row["日時"],
+                "student_name": row["受講者"],
+                "semester": row["学期"]
+            })
+        self.backend.insert_history(data)
+        self.bump("history")
+        self.rebuild_closed_view()
+
+    def reset_history(self):
+        self.backend.clear("history")
+        self.bump("history")
+        self.rebuild_closed_view()
+
+    # --- 募集停止中の学生画面 (名簿 + 各自の確定レッスン) ---
+    # 1つの文書 (documents の CLOSED_VIEW 行) にまとめておき、停止中はこれだけを読む。
+    # 履歴 (と名簿) が変わったときだけ作り直す。
+
+    def _closed_view_versions(self):
+        return {t: self._version(t) for t in CLOSED_VIEW_TABLES}
+
+    def rebuild_closed_view(self):
+        lessons = {}
+        for date_text, name in zip(*self._history_columns(("date_text", "student_name"))):
+            lessons.setdefault(name, []).append(date_text)
+        view = {
+            "versions": self._closed_view_versions(),
+            "students": self.load_students(),
+            "lessons": {name: sorted(slots, key=slot_sort_key) for name, slots in lessons.items()},
+        }
+        try: self.backend.put_document(CLOSED_VIEW, view)
+        except Exception as e: logger.info("%s を保存できませんでした: %s", CLOSED_VIEW, e)
+        return view
+
+    def _fetch_closed_view(self):
+        try: view = self.backend.get_document(CLOSED_VIEW)
+        except Exception as e:
+            # documents テーブルがまだ無いDBでだけ、その場で作る (通信エラーなどはそのまま)
+            if not is_missing_relation(e): raise
+            logger.info("%s を読めないため作り直します: %s", CLOSED_VIEW, e)
+            view = None
+        # 無い・古い (作成後に履歴や名簿が変わった) ときだけ作り直す
+        if view is None or view.get("versions") != self._closed_view_versions(): view = self.rebuild_closed_view()
+        return view
+
+    def load_closed_view(self):
+        # {"students": [氏名], "lessons": {氏名: [確定レッスン (年度順)]}}
+        view = self._cached(CLOSED_VIEW_TABLES, self._fetch_closed_view, variant=CLOSED_VIEW)
+        return {"students": list(view["students"]), "lessons": {k: list(v) for k, v in view["lessons"].items()}}
+
+    # --- シフトの下書き ---
+
+    def load_draft(self):
+        # 最新の下書き {id, created_at, schedule: {枠: 受講者}, wishes: {学生: [枠]}} (無ければ None)
+        draft = self._cached("drafts", self.backend.latest_draft)
+        if draft is None: return None
+        return {**draft, "schedule": dict(draft["schedule"]), "wishes": {k: list(v) for k, v in draft["wishes"].items()}}
+
+    def save_draft(self, schedule, wishes):
+        # wishes: 作成に使った希望 (次の再計算で変わった学生を見つけるため一緒に残す)
+        self.backend.insert_draft({
+            "created_at": datetime.now().astimezone().isoformat(timespec="seconds"),
+            "schedule": dict(schedule),
+            "wishes": {name: list(slots) for name, slots in wishes.items()},
+        })
+        self.bump("drafts")
+
+    def reset_drafts(self):
+        self.backend.clear("drafts")
+        self.bump("drafts")
+
+    # --- 名簿 ---
+
+    def _fetch_students(self):
+        return sorted(self.backend.list_keys("students"))
+
+    def load_students(self):
+        return list(self._cached("students", self._fetch_students))
+
+    def save_students(self, name_list):
+        name_list = sorted(set(name_list))
+        added, removed = self._sync_column("students", name_list)
+        if removed: self.bump("students", "requests")
+        elif added: self.bump("students")
+        return added, removed
+
+    # --- 先読み ---
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="lesson-prefetch")
+            return self._pool
+
+    def snapshot(self, fields=None):
+        # refresh() の後に1回呼ぶ。互いに独立した読み込みを並行して投げるので、
+        # 待ち時間は合計ではなく一番遅い1件分になる (キャッシュが新しいものは往復なし)
+        # fields: 読む項目 (省略時は全部)。読まなかった項目は None のまま
+        loaders = {
+            "slots": self.load_slots,
+            "students": self.load_students,
+            "request_rows": self.load_request_rows,
+            "slot_demand": self.load_slot_demand,
+            "history_counts": self.load_history_counts,
+            "history": self.load_history,
+            "draft": self.load_draft,
+        }
+        if fields is not None: loaders = {name: fn for name, fn in loaders.items() if name in fields}
+        # 1件だけなら (学生タブの再実行でよくある) スレッドを使わずその場で読む
+        if len(loaders) <= 1: data = {name: fn() for name, fn in loaders.items()}
+        else:
+            pool = self._executor()
+            # 呼び出し元の contextvars (計測中の再実行など) をワーカーにも引き継ぐ
+            futures = {name: pool.submit(contextvars.copy_context().run, fn) for name, fn in loaders.items()}
+            data = {name: f.result() for name, f in futures.items()}
+        if "slots" in data: data["slots"] = sorted(data["slots"], key=slot_sort_key)
+        return Snapshot(is_open=self.get_is_open(), **data)
+
+    # ★募集スイッチの読み書き (refresh() で読んだ設定行から返す)
+    def get_is_open(self):
+        if self._settings is None: self.refresh()
+        if self._settings: return self._settings.get("is_open", True)
+        return True
+
+    def set_is_open(self, status: bool):
+        self.backend.update_settings({"is_open": status})
+        with self._lock:
+            if self._settings is not None: self._settings["is_open"] = status
+        # 停止した時点の内容で学生画面用の文書を用意しておく
+        if not status: self.rebuild_closed_view()
@@ -0,0 +1,197 @@
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# --- 計測 (オプトイン) ---
+# 再実行ごとに LessonDB の呼び出し・保存先への往復・画面の区間 (タブ描画、割り当て) の
+# 時間・行数・回数を記録する。設定: secrets の [profiling] enabled = true
+# (環境変数 LESSON_PROFILE=1 でも可)。無効のときは何も差し込まない。
+# 1回の再実行の結果は JSON 1行で logger "lesson.profile" にも出す。
+
+logger = logging.getLogger("lesson.profile")
+
+# 計測する LessonDB のメソッド (アプリから呼ばれる入口)
+DB_METHODS = ("refresh", "get_is_open", "set_is_open", "add_slots", "remove_slots", "submit_request",
+              "rebuild_closed_view")
+DB_PREFIXES = ("load_", "save_", "reset_")
+
+# 計測する保存先のメソッド (1回 ≒ 1往復。history_pages は2ページ目以降も数える)
+BACKEND_METHODS = (
+    "get_settings", "update_settings", "list_keys", "insert_keys", "delete_keys",
+    "list_requests", "upsert_request", "list_request_slots", "student_wishes",
+    "replace_student_wishes", "save_request", "slot_demand", "submit_requests", "history_pages",
+    "student_lessons", "history_counts", "insert_history", "latest_draft", "insert_draft",
+    "get_document", "put_document", "clear",
+)
+
+_current = contextvars.ContextVar("lesson_profile_rerun", default=None)
+
+
+def row_count(result):
+    # DataFrame / list / dict は件数、それ以外は0
+    try: return len(result) if not isinstance(result, (str, bytes)) else 0
+    except TypeError: return 0
+
+
+def percentile(values, q):
+    # 最近傍順位法 (q: 0〜100)
+    if not values: return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+class Rerun:
+    # 1回の再実行の記録
+    def __init__(self, label):
+        self.label = label
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.last = self.t0
+        self.wall = None
+        self.calls = {}   # 名前 -> {"n", "seconds", "rows"}
+
+    @property
+    def done(self):
+        return self.wall is not None
+
+    def add(self, name, seconds, rows):
+        stats = self.calls.setdefault(name, {"n": 0, "seconds": 0.0, "rows": 0})
+        stats["n"] += 1
+        stats["seconds"] += seconds
+        stats["rows"] += rows
+        self.last = time.perf_counter()
+
+    def total(self, kind, field):
+        return sum(s[field] for name, s in self.calls.items() if name.startswith(kind + "."))
+
+    def summary(self):
+        return {
+            "event": "rerun",
+            "label": self.label,
+            "started": self.started,
+            "wall_ms": round(self.wall * 1000, 2),
+            "db_calls": self.total("db", "n"),
+            "round_trips": self.total("backend", "n"),
+            "rows": self.total("backend", "rows"),
+            "calls": {name: {"n": s["n"], "ms": round(s["seconds"] * 1000, 2), "rows": s["rows"]}
+                      for name, s in self.calls.items()},
+        }
+
+
+class Profiler:
+    def __init__(self, enabled=False, keep_reruns=200, keep_samples=1000):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reruns = deque(maxlen=keep_reruns)   # 終わった再実行の summary()
+        self.samples = {}                         # 名前 -> deque[(seconds, rows)]
+        self.keep_samples = keep_samples
+
+    # --- 再実行の区切り ---
+
+    def start_rerun(self, label="page", previous=None):
+        # previous: 同じセッションの前回の Rerun (st.rerun()/st.stop() で最後まで届かなかったもの)
+        if not self.enabled: return None
+        if previous is not None and not previous.done: self._finish(previous, previous.last)
+        rerun = Rerun(label)
+        _current.set(rerun)
+        return rerun
+
+    def finish_rerun(self):
+        rerun = _current.get()
+        if rerun is None or rerun.done: return
+        self._finish(rerun, time.perf_counter())
+
+    def _finish(self, rerun, end):
+        rerun.wall = end - rerun.t0
+        summary = rerun.summary()
+        with self._lock:
+            self.reruns.append(summary)
+        logger.info(json.dumps(summary, ensure_ascii=False))
+
+    # --- 記録 ---
+
+    def record(self, name, seconds, rows=0):
+        with self._lock:
+            samples = self.samples.get(name)
+            if samples is None: samples = self.samples[name] = deque(maxlen=self.keep_samples)
+            samples.append((seconds, rows))
+        rerun = _current.get()
+        if rerun is not None and not rerun.done: rerun.add(name, seconds, rows)
+
+    @contextmanager
+    def section(self, name):
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.record("section." + name, time.perf_counter() - t0)
+
+    def _wrap(self, name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            result = method(*args, **kwargs)
+            if name == "backend.history_pages":
+                count, pages = result
+                result = (count, self._count_pages(name, pages, time.perf_counter() - t0))
+            else:
+                # 保存先が dict を返すのは設定行 (1行) だけ
+                rows = (1 if result else 0) if isinstance(result, dict) and name.startswith("backend.") else row_count(result)
+                self.record(name, time.perf_counter() - t0, rows)
+            return result
+        return wrapper
+
+    def _count_pages(self, name, pages, first_seconds):
+        # ページを読むたびに記録する (1ページ目は呼び出し自体の時間と合わせて1往復)
+        t0 = time.perf_counter()
+        for i, page in enumerate(pages):
+            seconds = time.perf_counter() - t0
+            if i == 0: self.record(name, first_seconds + seconds, len(page))
+            else: self.record(name + " (page)", seconds, len(page))
+            yield page
+            t0 = time.perf_counter()
+
+    def instrument(self, db):
+        # LessonDB とその保存先のメソッドをインスタンス上で差し替える
+        if not self.enabled: return db
+        for attr in dir(db):
+            if attr in DB_METHODS or attr.startswith(DB_PREFIXES):
+                setattr(db, attr, self._wrap("db." + attr, getattr(db, attr)))
+        for attr in BACKEND_METHODS:
+            setattr(db.backend, attr, self._wrap("backend." + attr, getattr(db.backend, attr)))
+        return db
+
+    # --- 集計 (管理画面用) ---
+
+    def slowest_reruns(self, n=10):
+        with self._lock:
+            reruns = list(self.reruns)
+        return sorted(reruns, key=lambda r: r["wall_ms"], reverse=True)[:n]
+
+    def call_stats(self):
+        # 名前ごとの回数・p50/p95 (ms)・平均行数
+        with self._lock:
+            samples = {name: list(s) for name, s in self.samples.items()}
+        stats = []
+        for name, values in sorted(samples.items()):
+            seconds = [v[0] for v in values]
+            stats.append({
+                "name": name,
+                "n": len(values),
+                "p50_ms": round(percentile(seconds, 50) * 1000, 2),
+                "p95_ms": round(percentile(seconds, 95) * 1000, 2),
+                "rows_avg": round(sum(v[1] for v in values) / len(values), 1),
+            })
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self.reruns.clear()
+            self.samples.clear()
@@ -0,0 +1,184 @@
+import re
+import unicodedata
+from datetime import datetime, timedelta
+from collections import defaultdict
+from functools import lru_cache
+from typing import NamedTuple
+
+# --- 枠文字列 ("9月11日(木) 10:00-10:50") の解析 ---
+
+_MONTH_RE = re.compile(r'(\d{1,2})月')
+_SORT_RE = re.compile(r'(\d{1,2})月(\d{1,2})日.*?(\d{1,2}):(\d{2})')
+_RANGE_RE = re.compile(r'(\d{1,2}:\d{2})-(\d{1,2}:\d{2})')
+UNKNOWN_SORT_KEY = (99, 99, 99, 99, 99)
+
+
+class Slot(NamedTuple):
+    text: str        # 元の文字列 (DBに保存される値)
+    date: str        # "9月11日(木)"
+    start: str       # "10:00" (時間帯がなければ "")
+    end: str         # "10:50" (時間帯がなければ "")
+    semester: str    # "前期" / "後期" / "不明"
+    sort_key: tuple  # 年度順 (4月始まり) の並び替えキー
+
+
+def _semester_of(text):
+    match = _MONTH_RE.search(text)
+    if match:
+        if 4 <= int(match.group(1)) <= 8: return "前期"
+        else: return "後期"
+    return "不明"
+
+
+def _sort_key_of(text):
+    match = _SORT_RE.search(text)
+    if match:
+        mo, d, h, m = map(int, match.groups())
+        # 1〜3月は年度の後ろに回す
+        return (1 if mo <= 3 else 0, mo, d, h, m)
+    return UNKNOWN_SORT_KEY
+
+
+@lru_cache(maxsize=4096)
+def parse_slot(text):
+    # 同じ文字列は一度だけ解析する (並び替え・グループ化・割り当てで共有)
+    date = text.split(" ")[0]
+    range_match = _RANGE_RE.search(text)
+    start, end = range_match.groups() if range_match else ("", "")
+    return Slot(text, date, start, end, _semester_of(text), _sort_key_of(text))
+
+
+def slot_sort_key(text):
+    return parse_slot(text).sort_key
+
+# --- 関数群 ---
+
+def normalize_date_text(text):
+    text = unicodedata.normalize('NFKC', text)
+    date_match = re.search(r'(\d{1,2})[\/\-月\.](\d{1,2})', text)
+    if not date_match: return text
+    month, day = int(date_match.group(1)), int(date_match.group(2))
+    now = datetime.now()
+    year = now.year
+    try: dt = datetime(year, month, day)
+    except: return text
+    weekdays = ["月", "火", "水", "木", "金", "土", "日"]
+    wk = weekdays[dt.weekday()]
+    date_str = f"{month}月{day}日({wk})"
+    time_match = re.search(r'(\d{1,2}[:：]\d{2})', text)
+    if time_match:
+        start_time_str = time_match.group(1).replace("：", ":")
+        range_match = re.search(r'(\d{1,2}[:：]\d{2})\s*[\-~〜]\s*(\d{1,2}[:：]\d{2})', text)
+        if range_match:
+            s_t = range_match.group(1).replace("：", ":")
+            e_t = range_match.group(2).replace("：", ":")
+            return f"{date_str} {s_t}-{e_t}"
+        else:
+            try:
+                st_obj = datetime.strptime(start_time_str, "%H:%M")
+                et_obj = st_obj + timedelta(minutes=50)
+                end_time_str = et_obj.strftime("%H:%M")
+                return f"{date_str} {start_time_str}-{end_time_str}"
+            except:
+                return f"{date_str} {start_time_str}"
+    return date_str
+
+def get_semester(date_str):
+    return parse_slot(date_str).semester
+
+def sort_slots(slot_list):
+    return sorted(slot_list, key=slot_sort_key)
+
+def group_continuous_slots(sorted_slots):
+    if not sorted_slots: return []
+    grouped_by_date = defaultdict(list)
+    for s in sorted_slots:
+        slot = parse_slot(s)
+        grouped_by_date[slot.date].append(slot)
+    summary_list = []
+    for date_key, day_slots in grouped_by_date.items():
+        current_start, current_end = None, None
+        count = 0
+        for slot in day_slots:
+            if not slot.start: continue
+            if current_start is None:
+                current_start, current_end = slot.start, slot.end
+                count = 1
+            elif current_end == slot.start:
+                current_end = slot.end
+                count += 1
+            else:
+                summary_list.append(f"{date_key} {current_start}〜{current_end} ({count}枠)")
+                current_start, current_end = slot.start, slot.end
+                count = 1
+        if current_start:
+            summary_list.append(f"{date_key} {current_start}〜{current_end} ({count}枠)")
+    return summary_list
+
+# --- 繰り返し枠の一括生成 (学期分) ---
+
+WEEKDAYS = ["月", "火", "水", "木", "金", "土", "日"]
+
+
+def generate_recurring_slots(start_date, end_date, weekdays, start_time, end_time,
+                             lesson_minutes=50, holidays=(), overflow=False):
+    # start_date〜end_date の指定曜日 (0=月) に、start_time から lesson_minutes 分の枠を並べる。
+    # overflow=False: end_time までに終わる枠だけ (🅰️時間内) / True: end_time 前に始まる枠まで (🅱️使い切り)
+    # どちらも 24:00 までに終わる枠だけ
+    # 戻り値: 列 "日付" (Timestamp), "枠" (文字列) の DataFrame (日付・時刻順)
+    import numpy as np
+    import pandas as pd
+
+    days = pd.date_range(start_date, end_date, freq="D")
+    holidays = pd.to_datetime(list(holidays))
+    days = days[days.weekday.isin(list(weekdays)) & ~days.isin(holidays)]
+    start_min = start_time.hour * 60 + start_time.minute
+    end_min = end_time.hour * 60 + end_time.minute
+    last_start = end_min - 1 if overflow else end_min - lesson_minutes
+    # 日付をまたぐ枠 (例: 23:50-24:40) は作らない
+    last_start = min(last_start, 24 * 60 - lesson_minutes)
+    starts = np.arange(start_min, last_start + 1, lesson_minutes)
+    if len(days) == 0 or len(starts) == 0:
+        return pd.DataFrame({"日付": pd.Series([], dtype="datetime64[ns]"), "枠": pd.Series([], dtype=str)})
+
+    # 日付 × 開始時刻 の全組み合わせをまとめて作る
+    day = days[np.repeat(np.arange(len(days)), len(starts))]
+    begin = np.tile(starts, len(days))
+    finish = begin + lesson_minutes
+
+    def hhmm(minutes):
+        return pd.Series(minutes // 60).map("{:02d}".format) + ":" + pd.Series(minutes % 60).map("{:02d}".format)
+
+    weekday = pd.Series(day.weekday).map(dict(enumerate(WEEKDAYS)))
+    date_text = pd.Series(day.month).astype(str) + "月" + pd.Series(day.day).astype(str) + "日(" + weekday + ")"
+    text = date_text + " " + hhmm(begin) + "-" + hhmm(finish)
+    return pd.DataFrame({"日付": day, "枠": text.to_numpy()})
+
+
+def weekly_slot_counts(df_plan):
+    # 週 (月曜始まり) ごとの枠数のプレビュー
+    import pandas as pd
+    if df_plan.empty: return pd.DataFrame({"週": [], "枠数": []})
+    week = df_plan["日付"] - pd.to_timedelta(df_plan["日付"].dt.weekday, unit="D")
+    counts = df_plan.groupby(week).size()
+    return pd.DataFrame({"週": [f"{d.month}/{d.day}〜" for d in counts.index], "枠数": counts.to_numpy()})
+
+
+def parse_holidays(text, start_date, end_date):
+    # "2025-09-23" または "9/23" (期間内の年として解釈) を1行・カンマ区切りで受け付ける
+    holidays = []
+    for token in re.split(r'[,\s、]+', unicodedata.normalize('NFKC', text)):
+        if not token: continue
+        full = re.fullmatch(r'(\d{4})[\/\-\.](\d{1,2})[\/\-\.](\d{1,2})', token)
+        short = re.fullmatch(r'(\d{1,2})[\/\-\.月](\d{1,2})日?', token)
+        if full:
+            holidays.append(datetime(*map(int, full.groups())).date())
+        elif short:
+            month, day = map(int, short.groups())
+            for year in range(start_date.year, end_date.year + 1):
+                try: d = datetime(year, month, day).date()
+                except ValueError: continue
+                if start_date <= d <= end_date: holidays.append(d)
+        else:
+            raise ValueError(token)
+    return holidays
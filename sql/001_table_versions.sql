@@ -0,0 +1,9 @@
+-- テーブルごとの版数 (キャッシュ無効化用)
+-- アプリは書き込みのたびに該当列を新しい値に更新し、
+-- 各再実行では app_settings の1行だけを読んで変更を検出する。
+alter table app_settings add column if not exists slots_version bigint not null default 0;
+alter table app_settings add column if not exists requests_version bigint not null default 0;
+alter table app_settings add column if not exists history_version bigint not null default 0;
+alter table app_settings add column if not exists students_version bigint not null default 0;
+
+insert into app_settings (id, is_open) values (1, true) on conflict (id) do nothing;
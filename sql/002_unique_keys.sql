@@ -0,0 +1,7 @@
+-- 差分同期 (save_slots / save_students) 用の一意キー
+-- 既存の重複行は id の小さい方を残して削除する。
+delete from slots a using slots b where a.date_text = b.date_text and a.id > b.id;
+delete from students a using students b where a.name = b.name and a.id > b.id;
+
+create unique index if not exists slots_date_text_key on slots (date_text);
+create unique index if not exists students_name_key on students (name);
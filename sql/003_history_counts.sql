@@ -0,0 +1,7 @@
+-- 半期ごとのレッスン回数 (DB側で集計して小さな結果だけ返す)
+create or replace view history_counts as
+select student_name, semester, count(*)::int as lessons
+from history
+group by student_name, semester;
+
+grant select on history_counts to anon, authenticated;
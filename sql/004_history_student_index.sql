@@ -0,0 +1,2 @@
+-- 学生ごとの確定レッスン表示 (history を student_name で絞り込む) 用
+create index if not exists history_student_name_idx on history (student_name);
@@ -0,0 +1,31 @@
+-- 希望を (学生, 枠) の1行ずつに正規化する
+-- 枠や名簿から消えた希望は連鎖削除され、残り続けない。
+create table if not exists request_slots (
+    student_name text not null references students (name) on delete cascade on update cascade,
+    date_text text not null references slots (date_text) on delete cascade on update cascade,
+    primary key (student_name, date_text)
+);
+-- 主キーが student_name 側の検索を、こちらが枠ごとの応募者の検索を受け持つ
+create index if not exists request_slots_date_text_idx on request_slots (date_text);
+
+-- 既存の requests.wishes (カンマ区切り) を移す。今の枠・名簿にないものは捨てる
+insert into request_slots (student_name, date_text)
+select distinct r.student_name, w.date_text
+from requests r
+cross join lateral unnest(string_to_array(r.wishes, ',')) as w (date_text)
+where r.wishes is not null and r.wishes <> ''
+  and exists (select 1 from slots s where s.date_text = w.date_text)
+  and exists (select 1 from students st where st.name = r.student_name)
+on conflict do nothing;
+
+-- requests.wishes は以後使わない (memo のみ)
+alter table requests alter column wishes drop not null;
+
+-- 枠ごとの応募数
+create or replace view slot_demand as
+select date_text, count(*)::int as applicants
+from request_slots
+group by date_text;
+
+grant select, insert, update, delete on request_slots to anon, authenticated;
+grant select on slot_demand to anon, authenticated;
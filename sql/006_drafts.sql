@@ -0,0 +1,13 @@
+-- シフトの下書き (作成・再計算のたびに1行追加して古い行を消し、最新の1行だけを使う)
+-- schedule: {枠: 受講者} / wishes: 作成時点の {学生: [希望枠]} (次回の再計算で変更を検出する)
+create table if not exists drafts (
+    id bigserial primary key,
+    created_at timestamptz not null default now(),
+    schedule jsonb not null,
+    wishes jsonb not null
+);
+
+alter table app_settings add column if not exists drafts_version bigint not null default 0;
+
+grant select, insert, delete on drafts to anon, authenticated;
+grant usage, select on sequence drafts_id_seq to anon, authenticated;
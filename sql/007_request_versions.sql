@@ -0,0 +1,63 @@
+-- 希望の楽観的排他 (古い画面からの送信で新しい希望を上書きしない)
+-- requests.version は書き込みのたびに1つ進む。
+alter table requests add column if not exists version bigint not null default 0;
+
+-- version を指定しない更新 (upsert など) でも版数を進める
+create or replace function bump_request_version() returns trigger
+language plpgsql as $$
+begin
+    if new.version is not distinct from old.version then
+        new.version := old.version + 1;
+    end if;
+    return new;
+end $$;
+
+drop trigger if exists requests_bump_version on requests;
+create trigger requests_bump_version before update on requests
+for each row execute function bump_request_version();
+
+-- 複数人分の送信を1回で書く。payload: [{student_name, memo, wishes: [...], version}]
+-- version が今の requests.version と同じ学生だけ書き、全員分の (書いた後の / 衝突した) 内容を同じ順で返す。
+create or replace function submit_requests(payload jsonb)
+returns table (student_name text, memo text, wishes text[], version bigint, ok boolean)
+language plpgsql as $$
+#variable_conflict use_column
+declare
+    item jsonb;
+    sname text;
+    expected bigint;
+    current_version bigint;
+    changed int;
+begin
+    for item in select value from jsonb_array_elements(payload) with ordinality order by ordinality loop
+        sname := item->>'student_name';
+        expected := coalesce((item->>'version')::bigint, 0);
+        select r.version into current_version from requests r where r.student_name = sname for update;
+        ok := false;
+        if coalesce(current_version, 0) = expected then
+            insert into requests as r (student_name, memo, version)
+            values (sname, item->>'memo', expected + 1)
+            on conflict (student_name) do update set memo = excluded.memo, version = excluded.version
+            where r.version = expected;
+            get diagnostics changed = row_count;
+            ok := changed > 0;
+        end if;
+        if ok then
+            delete from request_slots rs where rs.student_name = sname;
+            -- 今の枠・名簿にない希望は捨てる
+            insert into request_slots (student_name, date_text)
+            select sname, w.date_text
+            from jsonb_array_elements_text(item->'wishes') as w (date_text)
+            where exists (select 1 from slots s where s.date_text = w.date_text)
+              and exists (select 1 from students st where st.name = sname)
+            on conflict do nothing;
+        end if;
+        student_name := sname;
+        select r.memo, r.version into memo, version from requests r where r.student_name = sname;
+        version := coalesce(version, 0);
+        select coalesce(array_agg(rs.date_text), '{}') into wishes from request_slots rs where rs.student_name = sname;
+        return next;
+    end loop;
+end $$;
+
+grant execute on function submit_requests(jsonb) to anon, authenticated;
@@ -0,0 +1,9 @@
+-- アプリが作る小さな文書 (JSON) の置き場所
+-- closed_view: 募集停止中の学生画面用 (名簿 + 各自の確定レッスン)。履歴・名簿が変わったときだけ作り直す。
+create table if not exists documents (
+    name text primary key,
+    body jsonb not null,
+    updated_at timestamptz not null default now()
+);
+
+grant select, insert, update on documents to anon, authenticated;
@@ -0,0 +1,570 @@
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from urllib.parse import quote
+
+# --- 保存先 (ストレージ) ---
+# LessonDB (db.py) が使う読み書きをここにまとめ、Supabase と SQLite を差し替えられるようにする。
+# 設定: secrets の [storage] backend = "supabase" | "sqlite" (環境変数 LESSON_STORAGE でも可)
+
+SYNC_CHUNK = 500   # 1回のリクエストで送る最大行数
+URL_FILTER_BYTES = 4000  # URL の条件 (in_) に入れる値の合計の上限 (エンコード後)。URL長の制限 8〜16KB より十分小さく
+PAGE_SIZE = 1000   # PostgREST の既定の最大行数に合わせる
+
+# 一意キーで差分同期するテーブル
+KEY_COLUMNS = {"slots": "date_text", "students": "name"}
+# clear() で全行に当たる条件 (id 列の無いテーブルは主キーの列で絞る)
+CLEAR_FILTERS = {"request_slots": ("student_name", ""), "documents": ("name", "")}
+SETTINGS_COLUMNS = ("is_open", "slots_version", "requests_version", "history_version", "students_version",
+                    "drafts_version")
+
+# ストアド関数が無いときのエラーコード (Postgres の undefined_function / PostgREST の関数なし)
+MISSING_FUNCTION_CODES = ("42883", "PGRST202")
+# テーブル・ビューが無いときのエラーコード (Postgres の undefined_table / PostgREST のスキーマに無い)
+MISSING_RELATION_CODES = ("42P01", "PGRST205")
+
+
+def is_missing_function(error):
+    # 古いDB (マイグレーション前) で rpc() が失敗したかどうか。通信エラーなどは False
+    return str(getattr(error, "code", "")) in MISSING_FUNCTION_CODES
+
+
+def is_missing_relation(error):
+    # 古いDB でテーブル・ビューが無いかどうか。通信エラーなどは False
+    if isinstance(error, sqlite3.OperationalError): return "no such table" in str(error)
+    return str(getattr(error, "code", "")) in MISSING_RELATION_CODES
+
+
+def chunked(items, size=SYNC_CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def chunked_for_url(items, limit=URL_FILTER_BYTES):
+    # URL に載せる条件用: エンコード後の長さで区切る (日本語の枠は1件60バイトほどになる)
+    chunk, size = [], 0
+    for item in items:
+        n = len(quote(str(item), safe="")) + 3   # 引用符と区切りの分
+        if chunk and size + n > limit:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(item)
+        size += n
+    if chunk: yield chunk
+
+
+class StorageBackend(ABC):
+    # すべての保存先が実装する操作 (足りない保存先は作成時に TypeError になる)
+
+    # app_settings (id=1 の1行)
+    @abstractmethod
+    def get_settings(self): ...
+    @abstractmethod
+    def update_settings(self, values): ...
+
+    # slots / students (KEY_COLUMNS の列の値の集合として扱う)
+    @abstractmethod
+    def list_keys(self, table): ...
+    @abstractmethod
+    def insert_keys(self, table, values): ...       # 既にある値は無視する
+    @abstractmethod
+    def delete_keys(self, table, values): ...       # 削除した行数を返す
+
+    # requests (氏名とメモ) と request_slots (学生, 枠) の希望
+    @abstractmethod
+    def list_requests(self): ...
+    @abstractmethod
+    def upsert_request(self, row): ...
+    @abstractmethod
+    def list_request_slots(self): ...               # [{student_name, date_text}]
+    @abstractmethod
+    def student_wishes(self, name): ...
+    @abstractmethod
+    def replace_student_wishes(self, name, slots): ...
+    @abstractmethod
+    def save_request(self, name, memo, slots): ...  # 氏名・メモと希望を版数の確認なしで書く
+    @abstractmethod
+    def slot_demand(self): ...                      # [{date_text, applicants}]
+    # 複数人分の希望をまとめて書く (楽観的排他: rows の version が DB の requests.version と同じ行だけ)
+    # rows: [{student_name, memo, wishes, version}]
+    # 戻り値: rows と同じ順の [{student_name, memo, wishes, version, ok}] (書いた後 / 衝突時は DB 上の内容)
+    @abstractmethod
+    def submit_requests(self, rows): ...
+
+    # history
+    @abstractmethod
+    def history_pages(self, columns): ...           # (DB上の件数, 行のリストのイテレータ)
+    @abstractmethod
+    def student_lessons(self, name): ...
+    @abstractmethod
+    def history_counts(self): ...                   # [{student_name, semester, lessons}]
+    @abstractmethod
+    def insert_history(self, rows): ...
+
+    # drafts (シフトの下書き: {id, created_at, schedule, wishes})
+    @abstractmethod
+    def latest_draft(self): ...                     # 無ければ None
+    @abstractmethod
+    def insert_draft(self, row): ...                # 古い下書きは消す (最新の1行だけ残す)
+
+    # documents (名前 -> JSON の文書)
+    @abstractmethod
+    def get_document(self, name): ...               # 無ければ None
+    @abstractmethod
+    def put_document(self, name, body): ...
+
+    # 全削除 (リセットボタン)
+    @abstractmethod
+    def clear(self, table): ...
+
+
+# --- Supabase ---
+
+class SupabaseBackend(StorageBackend):
+    def __init__(self, client):
+        self.client = client
+
+    def get_settings(self):
+        res = self.client.table("app_settings").select("*").eq("id", 1).execute()
+        return res.data[0] if res.data else {}
+
+    def update_settings(self, values):
+        self.client.table("app_settings").upsert({"id": 1, **values}).execute()
+
+    def list_keys(self, table):
+        column = KEY_COLUMNS[table]
+        return [item[column] for page in self._pages(table, column, order=column)[1] for item in page]
+
+    def insert_keys(self, table, values):
+        column = KEY_COLUMNS[table]
+        for chunk in chunked(values):
+            # 同時に追加された行とぶつかっても重複させない
+            self.client.table(table).upsert(
+                [{column: v} for v in chunk], on_conflict=column, ignore_duplicates=True
+            ).execute()
+
+    def delete_keys(self, table, values):
+        column = KEY_COLUMNS[table]
+        removed = 0
+        for chunk in chunked_for_url(values):
+            response = self.client.table(table).delete().in_(column, chunk).execute()
+            removed += len(response.data or [])
+        return removed
+
+    def list_requests(self):
+        return self.client.table("requests").select("*").execute().data or []
+
+    def upsert_request(self, row):
+        self.client.table("requests").upsert(row, on_conflict="student_name").execute()
+
+    def list_request_slots(self):
+        rows = []
+        # 主キー全体で並べる (同じ順位の行はページ間で入れ替わり、重複・欠落しうる)
+        for page in self._pages("request_slots", "student_name,date_text", order=("student_name", "date_text"))[1]:
+            rows.extend(page)
+        return rows
+
+    def student_wishes(self, name):
+        response = self.client.table("request_slots").select("date_text").eq("student_name", name).execute()
+        return [item["date_text"] for item in response.data]
+
+    def replace_student_wishes(self, name, slots):
+        # 差分だけ削除・追加する
+        stored = set(self.student_wishes(name))
+        desired = set(slots)
+        removed = [s for s in stored if s not in desired]
+        for chunk in chunked_for_url(removed):
+            self.client.table("request_slots").delete().eq("student_name", name).in_("date_text", chunk).execute()
+        added = [s for s in slots if s not in stored]
+        for chunk in chunked(added):
+            self.client.table("request_slots").upsert(
+                [{"student_name": name, "date_text": s} for s in chunk],
+                on_conflict="student_name,date_text", ignore_duplicates=True,
+            ).execute()
+
+    def save_request(self, name, memo, slots):
+        # PostgREST では2つの書き込みを1トランザクションにできないので順に書く
+        self.upsert_request({"student_name": name, "memo": memo})
+        self.replace_student_wishes(name, slots)
+
+    def slot_demand(self):
+        return [item for page in self._pages("slot_demand", "date_text,applicants", order="date_text")[1] for item in page]
+
+    def submit_requests(self, rows):
+        # 1往復で全員分を書く (sql/007_request_versions.sql の関数)
+        return self.client.rpc("submit_requests", {"payload": rows}).execute().data or []
+
+    def _pages(self, table, select, order="id", count=False):
+        # PAGE_SIZE 行ずつ範囲指定で読む (1回の select では API の行数上限で黙って切り捨てられるため)
+        # order: 一意になる列 (複数列ならタプル)。同じ順位の行があるとページの境目で重複・欠落する
+        # 戻り値: (count=True なら DB上の件数, ページのイテレータ)
+        columns = (order,) if isinstance(order, str) else tuple(order)
+
+        def ordered(query):
+            for column in columns: query = query.order(column)
+            return query
+
+        query = self.client.table(table).select(select, count="exact") if count else self.client.table(table).select(select)
+        first = ordered(query).range(0, PAGE_SIZE - 1).execute()
+
+        def pages():
+            page = first.data or []
+            start = len(page)
+            yield page
+            while len(page) == PAGE_SIZE:
+                response = ordered(self.client.table(table).select(select)).range(start, start + PAGE_SIZE - 1).execute()
+                page = response.data or []
+                start += len(page)
+                yield page
+        return first.count, pages()
+
+    def history_pages(self, columns):
+        return self._pages("history", ",".join(columns), count=True)
+
+    def student_lessons(self, name):
+        response = self.client.table("history").select("date_text").eq("student_name", name).execute()
+        return [item["date_text"] for item in response.data]
+
+    def history_counts(self):
+        return self.client.table("history_counts").select("student_name,semester,lessons").execute().data or []
+
+    def insert_history(self, rows):
+        for chunk in chunked(rows):
+            self.client.table("history").insert(chunk).execute()
+
+    def latest_draft(self):
+        response = self.client.table("drafts").select("*").order("id", desc=True).limit(1).execute()
+        return response.data[0] if response.data else None
+
+    def insert_draft(self, row):
+        inserted = self.client.table("drafts").insert(row).execute().data
+        # 使うのは最新の1行だけなので、それより前の下書きは消す
+        if inserted: self.client.table("drafts").delete().lt("id", inserted[0]["id"]).execute()
+
+    def get_document(self, name):
+        response = self.client.table("documents").select("body").eq("name", name).execute()
+        return response.data[0]["body"] if response.data else None
+
+    def put_document(self, name, body):
+        self.client.table("documents").upsert({"name": name, "body": body}, on_conflict="name").execute()
+
+    def clear(self, table):
+        # PostgREST は条件なしの delete を受け付けないので、全行に当たる条件を付ける
+        column, value = CLEAR_FILTERS.get(table, ("id", 0))
+        self.client.table(table).delete().neq(column, value).execute()
+
+
+# --- SQLite ---
+# 先生1人の小さな運用向け。ネットワーク往復がなく、オフラインでも動く。
+
+SQLITE_SCHEMA = """
+create table if not exists app_settings (
+    id integer primary key,
+    is_open integer not null default 1,
+    slots_version integer not null default 0,
+    requests_version integer not null default 0,
+    history_version integer not null default 0,
+    students_version integer not null default 0,
+    drafts_version integer not null default 0
+);
+insert or ignore into app_settings (id) values (1);
+
+create table if not exists slots (
+    id integer primary key autoincrement,
+    date_text text not null unique
+);
+create table if not exists students (
+    id integer primary key autoincrement,
+    name text not null unique
+);
+create table if not exists requests (
+    id integer primary key autoincrement,
+    student_name text not null unique,
+    wishes text,
+    memo text,
+    version integer not null default 0
+);
+create table if not exists history (
+    id integer primary key autoincrement,
+    date_text text not null,
+    student_name text not null,
+    semester text
+);
+create index if not exists history_student_name_idx on history (student_name, semester);
+
+create table if not exists request_slots (
+    student_name text not null references students (name) on delete cascade on update cascade,
+    date_text text not null references slots (date_text) on delete cascade on update cascade,
+    primary key (student_name, date_text)
+);
+create index if not exists request_slots_date_text_idx on request_slots (date_text);
+
+create table if not exists drafts (
+    id integer primary key autoincrement,
+    created_at text not null,
+    schedule text not null,
+    wishes text not null
+);
+
+create table if not exists documents (
+    name text primary key,
+    body text not null,
+    updated_at text not null default (datetime('now'))
+);
+"""
+
+
+# 後から増えた列 (古いファイルに足す)
+ADDED_COLUMNS = {
+    "app_settings": [c for c in SETTINGS_COLUMNS if c.endswith("_version")],
+    "requests": ["version"],
+}
+
+
+def _migrate_columns(conn):
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {r["name"] for r in conn.execute(f"pragma table_info({table})")}
+        for column in columns:
+            if column not in existing:
+                conn.execute(f"alter table {table} add column {column} integer not null default 0")
+
+
+def _migrate_wishes(conn):
+    # requests.wishes (カンマ区切り) から request_slots へ移し、同じトランザクションで旧列を空にする
+    # (残しておくと、希望を全部取り消した後などに再起動でまた読み込まれる)
+    rows = conn.execute("select student_name, wishes from requests where wishes is not null and wishes != ''").fetchall()
+    if not rows: return
+    # request_slots に行があれば移行は済んでいる (旧列を残していた版) ので、空にするだけ
+    migrated = conn.execute("select 1 from request_slots limit 1").fetchone() is not None
+    pairs = [] if migrated else [(r["student_name"], w) for r in rows for w in r["wishes"].split(",") if w]
+    conn.execute("begin")
+    try:
+        conn.executemany(
+            "insert or ignore into request_slots (student_name, date_text) "
+            "select ?1, ?2 where exists (select 1 from slots where date_text = ?2) "
+            "and exists (select 1 from students where name = ?1)", pairs)
+        conn.execute("update requests set wishes = null where wishes is not null")
+        conn.execute("commit")
+    except:
+        conn.execute("rollback")
+        raise
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def sqlite_connection(path):
+    # プロセスごとにファイル1つにつき接続を1本だけ作り、使い回す
+    # 戻り値: (接続, その接続を使うときに取るロック)
+    path = os.path.abspath(path)
+    with _connections_lock:
+        if path not in _connections:
+            conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=normal")
+            conn.execute("pragma foreign_keys=on")
+            conn.executescript(SQLITE_SCHEMA)
+            _migrate_columns(conn)
+            _migrate_wishes(conn)
+            _connections[path] = (conn, threading.RLock())
+        return _connections[path]
+
+
+class SQLiteBackend(StorageBackend):
+    def __init__(self, path="lesson_app.db"):
+        self.path = path
+        self.conn, self.lock = sqlite_connection(path)
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return [dict(r) for r in self.conn.execute(sql, params).fetchall()]
+
+    def _write(self, sql, rows):
+        # まとめて1トランザクションで書く。変更行数を返す
+        with self.lock:
+            self.conn.execute("begin")
+            try:
+                before = self.conn.total_changes
+                self.conn.executemany(sql, rows)
+                changed = self.conn.total_changes - before
+                self.conn.execute("commit")
+            except:
+                self.conn.execute("rollback")
+                raise
+        return changed
+
+    def get_settings(self):
+        rows = self._query("select * from app_settings where id = 1")
+        if not rows: return {}
+        settings = rows[0]
+        settings["is_open"] = bool(settings["is_open"])
+        return settings
+
+    def update_settings(self, values):
+        columns = [c for c in values if c in SETTINGS_COLUMNS]
+        if not columns: return
+        sql = f"update app_settings set {', '.join(f'{c} = ?' for c in columns)} where id = 1"
+        self._write(sql, [[values[c] for c in columns]])
+
+    def list_keys(self, table):
+        column = KEY_COLUMNS[table]
+        return [r[column] for r in self._query(f"select {column} from {table}")]
+
+    def insert_keys(self, table, values):
+        column = KEY_COLUMNS[table]
+        self._write(f"insert or ignore into {table} ({column}) values (?)", [[v] for v in values])
+
+    def delete_keys(self, table, values):
+        column = KEY_COLUMNS[table]
+        return self._write(f"delete from {table} where {column} = ?", [[v] for v in values])
+
+    def list_requests(self):
+        return self._query("select id, student_name, memo, version from requests order by id")
+
+    def upsert_request(self, row):
+        # 版数の確認なしで上書きする (版数は1つ進める)
+        self._write(
+            "insert into requests (student_name, memo, version) values (?, ?, 1) "
+            "on conflict (student_name) do update set memo = excluded.memo, version = requests.version + 1",
+            [[row["student_name"], row.get("memo")]],
+        )
+
+    def list_request_slots(self):
+        return self._query("select student_name, date_text from request_slots order by student_name")
+
+    def student_wishes(self, name):
+        return [r["date_text"] for r in self._query("select date_text from request_slots where student_name = ?", (name,))]
+
+    def _replace_wishes(self, name, slots):
+        # トランザクションの中で呼ぶ。
+        # 今の枠・名簿にない希望は捨てる (insert or ignore は外部キー違反を無視しないため)
+        self.conn.execute("delete from request_slots where student_name = ?", (name,))
+        self.conn.executemany(
+            "insert or ignore into request_slots (student_name, date_text) "
+            "select ?1, ?2 where exists (select 1 from slots where date_text = ?2) "
+            "and exists (select 1 from students where name = ?1)",
+            [(name, s) for s in slots])
+
+    def replace_student_wishes(self, name, slots):
+        with self.lock:
+            self.conn.execute("begin")
+            try:
+                self._replace_wishes(name, slots)
+                self.conn.execute("commit")
+            except:
+                self.conn.execute("rollback")
+                raise
+
+    def save_request(self, name, memo, slots):
+        # 氏名・メモと希望を1トランザクションで書く (途中で失敗してもメモだけ残らない)
+        with self.lock:
+            self.conn.execute("begin")
+            try:
+                self.conn.execute(
+                    "insert into requests (student_name, memo, version) values (?, ?, 1) "
+                    "on conflict (student_name) do update set memo = excluded.memo, version = requests.version + 1",
+                    (name, memo))
+                self._replace_wishes(name, slots)
+                self.conn.execute("commit")
+            except:
+                self.conn.execute("rollback")
+                raise
+
+    def slot_demand(self):
+        return self._query("select date_text, count(*) as applicants from request_slots group by date_text")
+
+    def submit_requests(self, rows):
+        results = []
+        with self.lock:
+            self.conn.execute("begin")
+            try:
+                for row in rows:
+                    name = row["student_name"]
+                    stored = self.conn.execute("select version from requests where student_name = ?", (name,)).fetchone()
+                    current = stored["version"] if stored else 0
+                    ok = current == row["version"]
+                    if ok:
+                        self.conn.execute(
+                            "insert into requests (student_name, memo, version) values (?, ?, ?) "
+                            "on conflict (student_name) do update set memo = excluded.memo, version = excluded.version",
+                            (name, row.get("memo"), current + 1))
+                        self._replace_wishes(name, row["wishes"])
+                    saved = self.conn.execute("select memo, version from requests where student_name = ?", (name,)).fetchone()
+                    wishes = [r["date_text"] for r in self.conn.execute(
+                        "select date_text from request_slots where student_name = ?", (name,))]
+                    results.append({"student_name": name, "memo": saved["memo"] if saved else None,
+                                    "wishes": wishes, "version": saved["version"] if saved else 0, "ok": ok})
+                self.conn.execute("commit")
+            except:
+                self.conn.execute("rollback")
+                raise
+        return results
+
+    def history_pages(self, columns):
+        select = ", ".join(c for c in columns if c in ("date_text", "student_name", "semester"))
+        rows = self._query(f"select {select} from history order by id")
+        return len(rows), iter([rows])
+
+    def student_lessons(self, name):
+        return [r["date_text"] for r in self._query("select date_text from history where student_name = ?", (name,))]
+
+    def history_counts(self):
+        return self._query(
+            "select student_name, semester, count(*) as lessons from history group by student_name, semester"
+        )
+
+    def insert_history(self, rows):
+        self._write(
+            "insert into history (date_text, student_name, semester) values (?, ?, ?)",
+            [[r["date_text"], r["student_name"], r.get("semester")] for r in rows],
+        )
+
+    def latest_draft(self):
+        rows = self._query("select * from drafts order by id desc limit 1")
+        if not rows: return None
+        draft = rows[0]
+        draft["schedule"], draft["wishes"] = json.loads(draft["schedule"]), json.loads(draft["wishes"])
+        return draft
+
+    def insert_draft(self, row):
+        # 追加と古い下書きの削除を1トランザクションで (使うのは最新の1行だけ)
+        with self.lock:
+            self.conn.execute("begin")
+            try:
+                cursor = self.conn.execute(
+                    "insert into drafts (created_at, schedule, wishes) values (?, ?, ?)",
+                    (row["created_at"], json.dumps(row["schedule"], ensure_ascii=False),
+                     json.dumps(row["wishes"], ensure_ascii=False)))
+                self.conn.execute("delete from drafts where id < ?", (cursor.lastrowid,))
+                self.conn.execute("commit")
+            except:
+                self.conn.execute("rollback")
+                raise
+
+    def get_document(self, name):
+        rows = self._query("select body from documents where name = ?", (name,))
+        return json.loads(rows[0]["body"]) if rows else None
+
+    def put_document(self, name, body):
+        self._write(
+            "insert into documents (name, body) values (?, ?) "
+            "on conflict (name) do update set body = excluded.body, updated_at = datetime('now')",
+            [[name, json.dumps(body, ensure_ascii=False, separators=(",", ":"))]],
+        )
+
+    def clear(self, table):
+        self._write(f"delete from {table}", [()])
+
+
+def create_backend(config):
+    # config: {"backend": "supabase", "url": ..., "key": ...} または {"backend": "sqlite", "path": ...}
+    kind = config.get("backend", "supabase")
+    if kind == "sqlite":
+        return SQLiteBackend(config.get("path", "lesson_app.db"))
+    if kind == "supabase":
+        from supabase import create_client
+        return SupabaseBackend(create_client(config["url"], config["key"]))
+    raise ValueError(f"unknown storage backend: {kind}")